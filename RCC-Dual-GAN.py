@@ -2,14 +2,23 @@ from keras.layers import Input, Dense, Dropout
 from keras.models import Sequential, Model
 from keras.optimizers import SGD
 import numpy as np
-import pandas as pd
 from collections import defaultdict
 import matplotlib.pyplot as plt
 import keras
 import math
 import argparse
-from keras.models import load_model
+import os
 import RCC
+import cache
+import checkpoint
+import data
+import ensemble
+import inference
+import metrics
+import parallel
+import scheduler
+import selection
+import telemetry
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run RCC-Dual-GAN.")
@@ -37,26 +46,56 @@ def parse_args():
                         help='Threshold 1.')
     parser.add_argument('--nash_thr_2', type=float, default=0.4,
                         help='Threshold 2.')
-    return parser.parse_args()
-
-# Sub-Generator
-def create_generator(latent_size):
-    gen = Sequential()
-    gen.add(Dense(latent_size, input_dim=latent_size, activation='relu', kernel_initializer=keras.initializers.Identity(gain=1.0)))
-    gen.add(Dense(latent_size, activation='relu', kernel_initializer=keras.initializers.Identity(gain=1.0)))
-    latent = Input(shape=(latent_size,))
-    fake_data = gen(latent)
-    return Model(latent, fake_data)
-
-# Sub-Discriminator
-def create_sub_discriminator(size):
-    dis = Sequential()
-    dis.add(Dense(size, input_dim=latent_size, activation='relu', kernel_initializer= keras.initializers.VarianceScaling(scale=1.0, mode='fan_in', distribution='normal', seed=None)))
-    dis.add(Dense(10, activation='relu', kernel_initializer=keras.initializers.VarianceScaling(scale=1.0, mode='fan_in', distribution='normal', seed=None)))
-    dis.add(Dense(1, activation='sigmoid',kernel_initializer=keras.initializers.VarianceScaling(scale=1.0, mode='fan_in', distribution='normal',seed=None)))
-    data = Input(shape=(latent_size,))
-    fake = dis(data)
-    return Model(data, fake)
+    parser.add_argument('--eval_every', type=int, default=1,
+                        help='Number of epochs between two evaluations of the model selection.')
+    parser.add_argument('--eval_size', type=int, default=0,
+                        help='Size of the stratified subsample used for model selection, 0 for all the data.')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='Number of epochs between two writes of the best model, 0 to write it at the end only.')
+    parser.add_argument('--state_every', type=int, default=0,
+                        help='Number of epochs between two checkpoints of the full training state, 0 for none.')
+    parser.add_argument('--state_path', nargs='?', default='training_state.pkl',
+                        help='Output the path of the training state checkpoint.')
+    parser.add_argument('--resume', type=int, default=0,
+                        help='1 to resume from the training state checkpoint if it exists, 0 to start over.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of processes training the sub-GANs, 0 to train them in the main process.')
+    parser.add_argument('--data_cache', nargs='?', default='',
+                        help='Input the directory of the binary caches of the data files, next to each file if empty.')
+    parser.add_argument('--rcc_subsample', type=int, default=0,
+                        help='Number of rows RCC runs on, the others join the cluster of their nearest representative. 0 for all the rows.')
+    parser.add_argument('--rcc_solver', nargs='?', default='spsolve', choices=['spsolve', 'cg', 'partitioned'],
+                        help='Linear solver of RCC, partitioned solves weakly coupled blocks on --rcc_jobs processes.')
+    parser.add_argument('--rcc_jobs', type=int, default=1,
+                        help='Number of blocks and processes of the partitioned RCC solver.')
+    parser.add_argument('--min_cluster_size', type=int, default=1,
+                        help='Clusters with fewer rows are merged into their nearest cluster in the RCC representative space.')
+    parser.add_argument('--max_subgans', type=int, default=0,
+                        help='Maximum number of sub-GANs of both sides, at least 2 (one per side), the nearest clusters are merged down to it. 0 for no maximum.')
+    parser.add_argument('--max_epoch_seconds', type=float, default=0,
+                        help='Budget of the sub-GAN steps of an epoch, measured on probe ensembles in the main process, clusters are merged to fit it. The estimate ignores --workers and is the cost of the first epochs with --shed. 0 for no budget.')
+    parser.add_argument('--rcc_cache', nargs='?', default='',
+                        help='Input the directory of the cache of RCC results, no cache if empty.')
+    parser.add_argument('--rcc_cache_size', type=float, default=1024,
+                        help='Size of the cache of RCC results in megabytes.')
+    parser.add_argument('--shared_trunk', type=int, default=0,
+                        help='1 to share the first layer of the sub-discriminators of each side, 0 for one per cluster.')
+    parser.add_argument('--shed', type=int, default=0,
+                        help='1 to freeze the converged sub-GANs and draw their points from cached pools, 0 to keep them in the ensembles.')
+    parser.add_argument('--pool_size', type=int, default=1000,
+                        help='Number of cached points of every frozen sub-generator.')
+    parser.add_argument('--refresh_every', type=int, default=50,
+                        help='Number of epochs between two refreshes of the cached points, 0 for never.')
+    parser.add_argument('--telemetry', nargs='?', default='',
+                        help='Output the path of the per-phase timings and per-epoch records, none if empty.')
+    parser.add_argument('--telemetry_format', nargs='?', default='jsonl', choices=['jsonl', 'csv'],
+                        help='Format of the telemetry records.')
+    parser.add_argument('--profile_epochs', nargs='?', default='',
+                        help='Comma separated epochs run under cProfile, dumped next to the telemetry file.')
+    args = parser.parse_args()
+    if 0 < args.max_subgans < 2:
+        parser.error('--max_subgans must be 0 or at least 2, every side keeps one sub-GAN')
+    return args
 
 # Discriminator
 def create_discriminator(size):
@@ -70,57 +109,56 @@ def create_discriminator(size):
     return Model(data, fake)
 
 
-# Load data
+# Load data, the rows are shuffled by the permutations rows_out and rows_unl
 def load_data():
-    data_out = pd.read_table('{path}'.format(path = args.path_out), sep=' ', header=None)
-    data_unl = pd.read_table('{path}'.format(path = args.path_unl), sep=' ', header=None)
-    data_out = data_out.sample(frac=1).reset_index(drop=True)
-    data_unl = data_unl.sample(frac=1).reset_index(drop=True)
-    id_out = data_out.pop(0)
-    id_unl = data_unl.pop(0)
-    y_out = data_out.pop(1)
-    y_unl = data_unl.pop(1)
-    data_out_x = data_out.as_matrix()
-    data_unl_x = data_unl.as_matrix()
-    data_id_out = id_out.values
-    data_id_unl = id_unl.values
-    data_out_y = y_out.values
-    data_unl_y = y_unl.values
-    return data_out_x, data_unl_x, data_id_out, data_id_unl, data_out_y, data_unl_y
+    data_out_x, data_id_out, data_out_y = data.load_table(args.path_out, cache_dir=args.data_cache or None)
+    data_unl_x, data_id_unl, data_unl_y = data.load_table(args.path_unl, cache_dir=args.data_cache or None)
+    rows_out = np.random.permutation(data_out_x.shape[0])
+    rows_unl = np.random.permutation(data_unl_x.shape[0])
+    return data_out_x, data_unl_x, data_id_out, data_id_unl, data_out_y, data_unl_y, rows_out, rows_unl
 
 # Load test data
 def load_test_data():
-    data = pd.read_table('{path}'.format(path = args.path_test), sep=' ', header=None)
-    data = data.sample(frac=1).reset_index(drop=True)
-    id = data.pop(0)
-    y = data.pop(1)
-    data_x = data.as_matrix()
-    data_id = id.values
-    data_y = y.values
-    return data_x, data_id, data_y
+    return data.load_table(args.path_test, cache_dir=args.data_cache or None)
 
+# Merge the clusters of one side smaller than min_cluster_size and down to max_clusters, the rows and their
+# representatives are relabelled alike so that the partition can be merged again
+def merge_partition(U, representative_labels, labels, n_clusters, max_clusters=None):
+    mapping, n_clusters = RCC.merge_clusters(U, representative_labels, min_size=args.min_cluster_size, max_clusters=max_clusters,
+                                             sizes=np.bincount(labels, minlength=n_clusters))
+    return mapping[labels], mapping[representative_labels], n_clusters
 
-# Euclidean distance
-def distEclud(x, weights):
-    dist = []
-    for w in weights:
-        d = np.linalg.norm(x-w)
-        dist.append(d)
-    return np.array(dist)
+# Estimate the time of the sub-GAN steps of an epoch on probe ensembles in the main process, bucketed as in training. It
+# does not model --workers, whose steps run in other processes, and with --shed it is the cost of the first epochs,
+# before converged sub-GANs are dropped from the ensembles
+def estimate_epoch_seconds(out_sizes, unl_sizes):
+    out_batch_sizes = [math.ceil((size * batch_out_size) / data_out_size) for size in out_sizes]
+    unl_batch_sizes = [math.ceil((size * batch_unl_size) / data_unl_size) for size in unl_sizes]
+    return (ensemble.probe_step_seconds(out_batch_sizes, latent_size, min(data_size, 1000), shared_trunk=bool(args.shared_trunk)) +
+            ensemble.probe_step_seconds(unl_batch_sizes, latent_size, min(data_size, 1000), shared_trunk=bool(args.shared_trunk)))
 
 
 if __name__ == '__main__':
     # initilize arguments
     args = parse_args()
 
+    # the training state of an interrupted run, None to start over
+    state = None
+    if args.resume and os.path.exists(args.state_path):
+        state = checkpoint.load(args.state_path)
+        print('Resuming from epoch {}'.format(state['epoch'] + 1))
+
+    timer = telemetry.Telemetry(args.telemetry or None, args.telemetry_format,
+                                profile_epochs=[int(v) for v in args.profile_epochs.split(',') if v],
+                                append=state is not None)
+
     # initialize dataset
-    data_out_x, data_unl_x, data_id_out, data_id_unl, data_out_y, data_unl_y = load_data()
-    data_x = np.concatenate((data_out_x, data_unl_x), axis=0)
-    data_y = np.concatenate((data_out_y, data_unl_y), axis=0)
+    with timer.phase('data_load'):
+        data_out_x, data_unl_x, data_id_out, data_id_unl, data_out_y, data_unl_y, rows_out, rows_unl = load_data()
     data_out_size = data_out_x.shape[0]
     data_unl_size = data_unl_x.shape[0]
     data_size = data_out_size + data_unl_size
-    latent_size = data_x.shape[1]
+    latent_size = data_out_x.shape[1]
     batch_size = min(args.batch_size, data_size)
     batch_out_size = min(100, data_out_size)
     batch_unl_size = min(batch_size - batch_out_size, data_unl_size)
@@ -128,302 +166,241 @@ if __name__ == '__main__':
     print("The dimensions of the outliers:{}*{}".format(data_out_size, latent_size))
     print("The dimensions of the unlabeled data:{}*{}".format(data_unl_size, latent_size))
 
-    names = locals()
     eva_list = []
-    eva_save = 1
-
-    # RCC
-    clusterer = RCC.RccCluster(measure='cosine')
-    if data_out_size > 2:
-        clu_out, k_out = clusterer.fit(data_out_x)
-        clu_out = pd.DataFrame(clu_out)
-        data_out_x = pd.DataFrame(data_out_x)
-        data_out_x_clu = np.concatenate((data_out_x, clu_out), axis=1)
-    elif data_out_size == 2:
-        clu_out = np.array([0] * (1) + [1] * (1))
-        clu_out = pd.DataFrame(clu_out)
-        data_out_x_clu = np.concatenate((data_out_x, clu_out), axis=1)
-        k_out = 2
+    # identified anomalies come first in data_x
+    eva_y = np.array([1] * data_out_size + [0] * data_unl_size)
+
+    # RCC, the partition of a resumed run is reused
+    rcc_cache = cache.RccCache(args.rcc_cache, args.rcc_cache_size) if args.rcc_cache else None
+    clusterer = RCC.RccCluster(measure='cosine', cache=rcc_cache, subsample=args.rcc_subsample or None, random_state=0,
+                               solver=args.rcc_solver, n_jobs=args.rcc_jobs)
+    if state is not None:
+        if state['partition']['rows_out'].shape[0] != data_out_size or state['partition']['rows_unl'].shape[0] != data_unl_size:
+            raise ValueError('the training state {} does not match the data'.format(args.state_path))
+        clu_out, k_out, clu_unl, k_unl, rows_out, rows_unl = [state['partition'][name] for name in ('clu_out', 'k_out', 'clu_unl', 'k_unl', 'rows_out', 'rows_unl')]
     else:
-        clu_out = np.array([0] * (1))
-        clu_out = pd.DataFrame(clu_out)
-        data_out_x_clu = np.concatenate((data_out_x, clu_out), axis=1)
-        k_out = 1
-    clu_unl, k_unl = clusterer.fit(data_unl_x)
-    clu_unl = pd.DataFrame(clu_unl)
-    data_unl_x = pd.DataFrame(data_unl_x)
-    data_unl_x_clu = np.concatenate((data_unl_x, clu_unl), axis=1)
-
-    # Divide data into different data subsets
-    for i in range(k_out):
-        names['data_out_x_' + str(i)] = []
-    for idx in range(data_out_size):
-        for i in range(k_out):
-            if data_out_x_clu[idx,-1] == i:
-                names['data_out_x_clu_' + str(idx)] = data_out_x_clu[idx, :-1].reshape(1, latent_size)
-                if names['data_out_x_' + str(i)] == []:
-                    names['data_out_x_' + str(i)] = names['data_out_x_clu_' + str(idx)]
-                else:
-                    names['data_out_x_' + str(i)] = np.concatenate((names['data_out_x_' + str(i)], names['data_out_x_clu_' + str(idx)]), axis=0)
-    for i in range(k_unl):
-        names['data_unl_x_' + str(i)] = []
-    for idx in range(data_unl_size):
-        for i in range(k_unl):
-            if data_unl_x_clu[idx,-1] == i:
-                names['data_unl_x_clu_' + str(idx)] = data_unl_x_clu[idx, :-1].reshape(1, latent_size)
-                if names['data_unl_x_' + str(i)] == []:
-                    names['data_unl_x_' + str(i)] = names['data_unl_x_clu_' + str(idx)]
-                else:
-                    names['data_unl_x_' + str(i)] = np.concatenate((names['data_unl_x_' + str(i)], names['data_unl_x_clu_' + str(idx)]), axis=0)
+        if data_out_size > 2:
+            clu_out, k_out = clusterer.fit(data_out_x)
+            for name, seconds in clusterer.timings_.items():
+                timer.add_phase(name, seconds)
+            U_out, representatives_out = clusterer.U, clusterer.representative_labels_
+        elif data_out_size == 2:
+            clu_out = np.array([0] * (1) + [1] * (1))
+            k_out = 2
+            U_out, representatives_out = data_out_x, clu_out
+        else:
+            clu_out = np.array([0] * (1))
+            k_out = 1
+            U_out, representatives_out = data_out_x, clu_out
+        clu_unl, k_unl = clusterer.fit(data_unl_x)
+        for name, seconds in clusterer.timings_.items():
+            timer.add_phase(name, seconds)
+        U_unl, representatives_unl = clusterer.U, clusterer.representative_labels_
+
+        # Merge the small clusters, then the nearest clusters until the sub-GANs fit the budget
+        with timer.phase('merge'):
+            clu_out, representatives_out, k_out = merge_partition(U_out, representatives_out, clu_out, k_out)
+            clu_unl, representatives_unl, k_unl = merge_partition(U_unl, representatives_unl, clu_unl, k_unl)
+            budget = args.max_subgans if args.max_subgans > 0 else None
+            if args.max_epoch_seconds > 0:
+                seconds = estimate_epoch_seconds(np.bincount(clu_out), np.bincount(clu_unl))
+                print('Estimated sub-GAN time per epoch: {:.4f}s for {} sub-GANs'.format(seconds, k_out + k_unl))
+                if seconds > args.max_epoch_seconds:
+                    fitting = max(2, int((k_out + k_unl) * args.max_epoch_seconds / seconds))
+                    budget = fitting if budget is None else min(budget, fitting)
+            if budget is not None and k_out + k_unl > budget:
+                cap_out = max(1, min(k_out, int(round(budget * k_out / float(k_out + k_unl)))))
+                clu_out, representatives_out, k_out = merge_partition(U_out, representatives_out, clu_out, k_out, cap_out)
+                clu_unl, representatives_unl, k_unl = merge_partition(U_unl, representatives_unl, clu_unl, k_unl, max(1, budget - cap_out))
+        print('The sizes of the clusters of the outliers: {}'.format(np.bincount(clu_out, minlength=k_out).tolist()))
+        print('The sizes of the clusters of the unlabeled data: {}'.format(np.bincount(clu_unl, minlength=k_unl).tolist()))
+    timer.write_phases('setup', out_size=data_out_size, unl_size=data_unl_size, features=latent_size, k_out=k_out, k_unl=k_unl,
+                       out_sizes=np.bincount(clu_out, minlength=k_out).tolist(), unl_sizes=np.bincount(clu_unl, minlength=k_unl).tolist())
+
+    # Divide data into different data subsets. The rows of each side are shuffled and sorted by cluster in one gather
+    # from the mapped cache straight into data_x, and every subset is a view of its rows, so the data is held once.
+    data_x = np.empty((data_size, latent_size), dtype=data_out_x.dtype)
+    data_out_x, out_offsets, out_order = data.partition(data_out_x, clu_out, k_out, out=data_x[:data_out_size], rows=rows_out)
+    data_unl_x, unl_offsets, unl_order = data.partition(data_unl_x, clu_unl, k_unl, out=data_x[data_out_size:], rows=rows_unl)
+    data_y = np.concatenate((data_out_y[out_order], data_unl_y[unl_order]), axis=0)
+    data_out_subsets = data.subsets(data_out_x, out_offsets)
+    data_unl_subsets = data.subsets(data_unl_x, unl_offsets)
     for i in range(k_out):
-        print(names['data_out_x_' + str(i)].shape)
+        print(data_out_subsets[i].shape)
     for i in range(k_unl):
-        print(names['data_unl_x_' + str(i)].shape)
+        print(data_unl_subsets[i].shape)
 
-    for i in range(k_out):
-        names['stop_out_' + str(i)] = 0
-    for i in range(k_unl):
-        names['stop_unl_' + str(i)] = 0
+    stop_out = np.zeros((k_out,), dtype=int)
+    stop_unl = np.zeros((k_unl,), dtype=int)
 
-    # Create sub-discriminator
-    for i in range(k_out):
-        names['discriminator_out_' + str(i)] = create_sub_discriminator(min(data_size,1000))
-        names['discriminator_out_' + str(i)].compile(optimizer=SGD(lr=args.lr_d, decay=args.decay, momentum=args.momentum), loss='binary_crossentropy')
-    for i in range(k_unl):
-        names['discriminator_unl_' + str(i)] = create_sub_discriminator(min(data_size,1000))
-        names['discriminator_unl_' + str(i)].compile(optimizer=SGD(lr=args.lr_d, decay=args.decay, momentum=args.momentum), loss='binary_crossentropy')
+    # Mini-batch sizes of the clusters, drawn by the samplers and used to bucket the sub-GANs
+    out_batch_sizes = [math.ceil((subset.shape[0] * batch_out_size) / data_out_size) for subset in data_out_subsets]
+    unl_batch_sizes = [math.ceil((subset.shape[0] * batch_unl_size) / data_unl_size) for subset in data_unl_subsets]
+    out_all_sizes = [int(mul * size) for size in out_batch_sizes]
+    unl_all_sizes = [math.ceil(batch_unl_size / k_unl)] * k_unl
 
     #Create discriminator
     discriminator_all = create_discriminator(min(data_size,1000))
     discriminator_all.compile(optimizer=SGD(lr=args.lr_d, decay=args.decay, momentum=args.momentum), loss='binary_crossentropy', metrics=['accuracy'])
 
-    # Create sub-generator and combine_model
-    for i in range(k_out):
-        names['generator_out_' + str(i)] = create_generator(latent_size)
-        latent = Input(shape=(latent_size,))
-        names['fake_out_' + str(i)] = names['generator_out_' + str(i)](latent)
-        names['discriminator_out_' + str(i)].trainable = False
-        names['fake_out_' + str(i)] = names['discriminator_out_' + str(i)](names['fake_out_' + str(i)])
-        names['combine_model_out_' + str(i)] = Model(latent, names['fake_out_' + str(i)])
-        names['combine_model_out_' + str(i)].compile(optimizer=SGD(lr=args.lr_g_out, decay=args.decay, momentum=args.momentum), loss='binary_crossentropy')
-    for i in range(k_unl):
-        names['generator_unl_' + str(i)] = create_generator(latent_size)
-        latent = Input(shape=(latent_size,))
-        names['fake_unl_' + str(i)] = names['generator_unl_' + str(i)](latent)
-        names['discriminator_unl_' + str(i)].trainable = False
-        names['fake_unl_' + str(i)] = names['discriminator_unl_' + str(i)](names['fake_unl_' + str(i)])
-        names['combine_model_unl_' + str(i)] = Model(latent, names['fake_unl_' + str(i)])
-        names['combine_model_unl_' + str(i)].compile(optimizer=SGD(lr=args.lr_g_unl, decay=args.decay, momentum=args.momentum), loss='binary_crossentropy')
+    # Create sub-generators, sub-discriminators and combine_models, fused into a few ensembles of clusters with similar
+    # mini-batch sizes per side or spread over a pool of worker processes. With --shed, the converged sub-GANs of a side
+    # are frozen and dropped from its ensembles
+    if args.workers > 0 and args.shed:
+        raise ValueError('--shed trains the sub-GANs in the main process, it cannot be used with --workers')
+    if args.workers > 0:
+        pool = parallel.SubGANWorkerPool(args.workers)
+        gans_out = parallel.ParallelSubGANs(pool, k_out, latent_size, min(data_size, 1000), args.lr_d, args.lr_g_out, args.decay, args.momentum, cluster_sizes=[subset.shape[0] for subset in data_out_subsets], shared_trunk=bool(args.shared_trunk), batch_sizes=out_batch_sizes)
+        gans_unl = parallel.ParallelSubGANs(pool, k_unl, latent_size, min(data_size, 1000), args.lr_d, args.lr_g_unl, args.decay, args.momentum, cluster_sizes=[subset.shape[0] for subset in data_unl_subsets], shared_trunk=bool(args.shared_trunk), batch_sizes=unl_batch_sizes)
+    elif args.shed:
+        gans_out = scheduler.SheddingSubGANs(k_out, latent_size, min(data_size, 1000), args.lr_d, args.lr_g_out, args.decay, args.momentum, shared_trunk=bool(args.shared_trunk), batch_sizes=out_batch_sizes, pool_size=args.pool_size, refresh_every=args.refresh_every)
+        gans_unl = scheduler.SheddingSubGANs(k_unl, latent_size, min(data_size, 1000), args.lr_d, args.lr_g_unl, args.decay, args.momentum, shared_trunk=bool(args.shared_trunk), batch_sizes=unl_batch_sizes, pool_size=args.pool_size, refresh_every=args.refresh_every)
+    else:
+        gans_out = ensemble.BucketedSubGANs(k_out, latent_size, min(data_size, 1000), args.lr_d, args.lr_g_out, args.decay, args.momentum, shared_trunk=bool(args.shared_trunk), batch_sizes=out_batch_sizes)
+        gans_unl = ensemble.BucketedSubGANs(k_unl, latent_size, min(data_size, 1000), args.lr_d, args.lr_g_unl, args.decay, args.momentum, shared_trunk=bool(args.shared_trunk), batch_sizes=unl_batch_sizes)
+
+    # The selection of optimal model, the best weights are kept in memory and written to discriminator.h5
+    # The evaluation subsample is seeded, so that a resumed run scores on the same rows
+    selector = selection.ModelSelector(discriminator_all, data_x, eva_y, eval_every=args.eval_every, eval_size=args.eval_size, checkpoint_every=args.checkpoint_every, seed=0)
 
     # Initialize the stop node
     epochs = args.max_iter
     stop_iter = epochs
     stop_iter_all = np.array([stop_iter] * (int(k_out + k_unl)))
 
+    # Mini-batch samplers, the data and noise of the next epoch are drawn in the background while an epoch trains
+    sampler_out = data.MiniBatchSampler(data_out_subsets, out_batch_sizes, noise_shapes=[(max(out_batch_sizes), k_out, latent_size), (max(out_all_sizes), k_out, latent_size)])
+    sampler_unl = data.MiniBatchSampler(data_unl_subsets, unl_batch_sizes, noise_shapes=[(max(unl_batch_sizes), k_unl, latent_size), (max(unl_all_sizes), k_unl, latent_size)])
+
+    # Restore the training state, everything but the random state of the backend, e.g. of dropout
+    start_epoch = 0
+    if state is not None:
+        gans_out.set_state(state['gans_out'])
+        gans_unl.set_state(state['gans_unl'])
+        checkpoint.restore_model(discriminator_all, state['discriminator_all'], state['discriminator_all_optimizer'],
+                                 data_x[:1], np.zeros((1,)), np.zeros((1,)))
+        selector.set_state(state['selector'])
+        sampler_out.set_state(state['sampler_out'])
+        sampler_unl.set_state(state['sampler_unl'])
+        stop_out, stop_unl, stop_iter, stop_iter_all, eva_list = [state[name] for name in ('stop_out', 'stop_unl', 'stop_iter', 'stop_iter_all', 'eva_list')]
+        np.random.set_state(state['np_random'])
+        start_epoch = state['epoch']
+    writer = checkpoint.CheckpointWriter(args.state_path) if args.state_every > 0 else None
+
+    # The sampler states after every sample are kept for the checkpoints
+    def sample():
+        samples = (sampler_out.sample(), sampler_unl.sample())
+        return samples + ((sampler_out.get_state(), sampler_unl.get_state()) if writer is not None else None,)
+    prefetcher = data.Prefetcher(sample)
+
     # Start iteration
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         print('Epoch {} of {}'.format(epoch + 1, epochs))
+        timer.start_epoch(epoch)
 
         # Sample mini-batch data
-        for i in range(k_out):
-            names['data_out_x_' + str(i)] = pd.DataFrame(names['data_out_x_' + str(i)])
-            names['data_out_batch_x_' + str(i)] = names['data_out_x_' + str(i)].sample(n=math.ceil((names['data_out_x_' + str(i)].shape[0] * batch_out_size) / data_out_size), replace=False, random_state=None, axis=0)
-        for i in range(k_unl):
-            names['data_unl_x_' + str(i)] = pd.DataFrame(names['data_unl_x_' + str(i)])
-            names['data_unl_batch_x_' + str(i)] = names['data_unl_x_' + str(i)].sample(n=math.ceil((names['data_unl_x_' + str(i)].shape[0] * batch_unl_size) / data_unl_size), replace=False, random_state=None, axis=0)
-
-        # Train sub-generators and sub-discriminators
-        for i in range(k_out):
-            names['data_out_batch_x_' + str(i)] = pd.DataFrame(names['data_out_batch_x_' + str(i)])
-            # Train sub-discriminators
-            noise = np.random.uniform(0, 1, (int(names['data_out_batch_x_'+str(i)].shape[0]), latent_size))
-            names['generated_data_out_'+str(i)] = names['generator_out_'+str(i)].predict(noise, verbose=0)
-            names['x_out_' + str(i)] = np.concatenate((names['data_out_batch_x_'+str(i)], names['generated_data_out_'+str(i)]), axis=0)
-            names['y_out_' + str(i)] = np.array([1] * (int(names['data_out_batch_x_'+str(i)].shape[0])) + [0] * (int(names['data_out_batch_x_'+str(i)].shape[0])))
-            names['discriminator_out' + str(i)] = names['discriminator_out_' + str(i)].train_on_batch(names['x_out_' + str(i)], names['y_out_' + str(i)])
-
-            # Train sub-generators
-            if names['stop_out_' + str(i)] == 0:
-                trick_out = np.array([1] * (names['data_out_batch_x_'+str(i)].shape[0]))
-                names['generator_out' + str(i)] = names['combine_model_out_' + str(i)].train_on_batch(noise, trick_out)
-
-                # The evaluation of Nash equilibrium
-                if stop_iter_all[i] == epochs:
-                    names['generated_data_out_' + str(i)] = pd.DataFrame(names['generated_data_out_' + str(i)])
-                    sample_num = min(10, names['data_out_batch_x_' + str(i)].shape[0])
-                    names['eva_nash_data_out_' + str(i)] = names['generated_data_out_' + str(i)].sample(sample_num, replace=False, random_state=None, axis=0)
-                    names['eva_nash_data_out_' + str(i)] = names['eva_nash_data_out_' + str(i)].as_matrix()
-                    names['nash_out_' + str(i)] = 0
-                    for idx in range(sample_num):
-                        real = 0
-                        dists_out = distEclud(names['eva_nash_data_out_' + str(i)][idx,], names['x_out_' + str(i)])
-                        dists_out = pd.DataFrame(dists_out)
-                        names['y_out_' + str(i)] = pd.DataFrame(names['y_out_' + str(i)])
-                        dists_out = np.concatenate((dists_out, names['y_out_' + str(i)]), axis=1)
-                        dists_out = pd.DataFrame(dists_out, columns=['d', 'y'])
-                        dists_out = dists_out.sort_values('d', ascending=True)
-                        dists_out = dists_out.as_matrix()
-                        for index in range(max(sample_num, 2)):
-                            if dists_out[index, 1] == 1:
-                                real = real + 1
-                        gen_real = real / max(sample_num, 2)
-                        if gen_real >= args.nash_thr_1:
-                            names['nash_out_' + str(i)] = names['nash_out_' + str(i)] + 1
-                    names['nash_out_' + str(i)] = names['nash_out_' + str(i)] / max(sample_num, 2)
-                    if names['nash_out_' + str(i)] >= args.nash_thr_2:
-                        stop_iter_all[i] = epoch + 1
-                    # print("The {}th subset contains {} samples, the evaluation of Nash equilibrium is {}".format(i, sample_num, names['nash_out_' + str(i)]))
-
-        for i in range(k_unl):
-            names['data_unl_batch_x_' + str(i)] = pd.DataFrame(names['data_unl_batch_x_' + str(i)])
-
-            # Train sub-discriminators
-            noise = np.random.uniform(0, 1, (int(names['data_unl_batch_x_' + str(i)].shape[0]), latent_size))
-            names['generated_data_unl_' + str(i)] = names['generator_unl_' + str(i)].predict(noise, verbose=0)
-            names['x_unl_' + str(i)] = np.concatenate((names['data_unl_batch_x_' + str(i)], names['generated_data_unl_' + str(i)]), axis=0)
-            names['y_unl_' + str(i)] = np.array([1] * (int(names['data_unl_batch_x_' + str(i)].shape[0])) + [0] * (int(names['data_unl_batch_x_' + str(i)].shape[0])))
-            names['discriminator_unl' + str(i)] = names['discriminator_unl_' + str(i)].train_on_batch(names['x_unl_' + str(i)], names['y_unl_' + str(i)])
-
-            # Train sub-generators
-            if names['stop_unl_' + str(i)] == 0:
-                trick_unl = np.array([1] * (int(names['data_unl_batch_x_' + str(i)].shape[0])))
-                names['generator_unl' + str(i)] = names['combine_model_unl_' + str(i)].train_on_batch(noise, trick_unl)
-
-                # The evaluation of Nash equilibrium
-                if stop_iter_all[i+k_out] == epochs:
-                    names['generated_data_unl_' + str(i)] = pd.DataFrame(names['generated_data_unl_' + str(i)])
-                    sample_num = min(10,names['data_unl_batch_x_' + str(i)].shape[0])
-                    names['eva_nash_data_unl_' + str(i)] = names['generated_data_unl_' + str(i)].sample(sample_num, replace=False, random_state=None, axis=0)
-                    names['eva_nash_data_unl_' + str(i)] = names['eva_nash_data_unl_' + str(i)].as_matrix()
-                    names['nash_unl_' + str(i)] = 0
-                    for idx in range(sample_num):
-                        real = 0
-                        dists_unl = distEclud(names['eva_nash_data_unl_' + str(i)][idx,], names['x_unl_' + str(i)])
-                        dists_unl = pd.DataFrame(dists_unl)
-                        names['y_unl_' + str(i)] = pd.DataFrame(names['y_unl_' + str(i)])
-                        dists_unl = np.concatenate((dists_unl, names['y_unl_' + str(i)]), axis=1)
-                        dists_unl = pd.DataFrame(dists_unl, columns=['d', 'y'])
-                        dists_unl = dists_unl.sort_values('d', ascending=True)
-                        dists_unl = dists_unl.as_matrix()
-                        for index in range(max(sample_num, 2)):
-                            if dists_unl[index,1] == 1:
-                                real = real +1
-                        gen_real = real/max(sample_num, 2)
-                        if gen_real>=args.nash_thr_1:
-                            names['nash_unl_' + str(i)] = names['nash_unl_' + str(i)] + 1
-                    names['nash_unl_' + str(i)] = names['nash_unl_' + str(i)]/max(sample_num, 2)
-                    if sample_num >= 2 and names['nash_unl_' + str(i)] >= args.nash_thr_2:
-                        names['stop_unl_' + str(i)] = 1
-                        stop_iter_all[i+k_out] = epoch + 1
-                    elif names['nash_unl_' + str(i)] >= args.nash_thr_2:
-                        stop_iter_all[i+k_out] = epoch + 1
-                    # print("The {}th subset contains {} samples, the evaluation of Nash equilibrium is {}".format(i, sample_num, names['nash_unl_' + str(i)]))
+        with timer.phase('sampling'):
+            (data_out_batches, (noise_out, noise_out_all)), (data_unl_batches, (noise_unl, noise_unl_all)), sampler_states = prefetcher.next()
+
+        # Train sub-generators and sub-discriminators, the Nash equilibrium of the sub-GANs of each side is evaluated
+        # together after their training step
+        active_out = stop_out == 0
+        nash_out = active_out & (stop_iter_all[:k_out] == epochs)
+        with timer.phase('sub_gan'):
+            nash_out_ratios, out_losses = gans_out.train_step(data_out_batches, active_out, nash_out, args.nash_thr_1, noise=noise_out)
+        for i in np.flatnonzero(nash_out):
+            if nash_out_ratios[i] >= args.nash_thr_2:
+                stop_iter_all[i] = epoch + 1
+            # print("The {}th subset, the evaluation of Nash equilibrium is {}".format(i, nash_out_ratios[i]))
+
+        active_unl = stop_unl == 0
+        nash_unl = active_unl & (stop_iter_all[k_out:] == epochs)
+        with timer.phase('sub_gan'):
+            nash_unl_ratios, unl_losses = gans_unl.train_step(data_unl_batches, active_unl, nash_unl, args.nash_thr_1, noise=noise_unl)
+        for i in np.flatnonzero(nash_unl):
+            sample_num = min(10, data_unl_batches[i].shape[0])
+            if sample_num >= 2 and nash_unl_ratios[i] >= args.nash_thr_2:
+                stop_unl[i] = 1
+                stop_iter_all[i+k_out] = epoch + 1
+            elif nash_unl_ratios[i] >= args.nash_thr_2:
+                stop_iter_all[i+k_out] = epoch + 1
+            # print("The {}th subset, the evaluation of Nash equilibrium is {}".format(i, nash_unl_ratios[i]))
 
         if stop_iter == epochs:
             stop_iter = max(stop_iter_all)
         else:
-            for i in range(k_unl):
-                names['stop_unl_' + str(i)] = 1
+            stop_unl[:] = 1
 
         # Train discriminators
-        for i in range(k_out):
-            if i==0:
-                data_out_batch = names['data_out_batch_x_' + str(i)]
-            else:
-                data_out_batch = np.concatenate((data_out_batch, names['data_out_batch_x_' + str(i)]), axis=0)
-        for i in range(k_unl):
-            if i==0:
-                data_unl_batch = names['data_unl_batch_x_' + str(i)]
-            else:
-                data_unl_batch = np.concatenate((data_unl_batch, names['data_unl_batch_x_' + str(i)]), axis=0)
-        for i in range(k_out):
-            noise_all = np.random.uniform(0, 1, (int(mul * names['data_out_batch_x_' + str(i)].shape[0]), latent_size))
-            names['generated_data_out_all_' + str(i)] = names['generator_out_' + str(i)].predict(noise_all, verbose=0)
-            if i==0:
-                x_out_all = np.concatenate((data_out_batch, names['generated_data_out_all_' + str(i)]), axis=0)
-            else:
-                x_out_all = np.concatenate((x_out_all, names['generated_data_out_all_' + str(i)]), axis=0)
-        for i in range(k_unl):
-            noise_all = np.random.uniform(0, 1, (math.ceil(batch_unl_size / k_unl), latent_size))
-            names['generated_data_unl_all_' + str(i)] = names['generator_unl_' + str(i)].predict(noise_all, verbose=0)
-            if i==0:
-                x_unl_all = np.concatenate((data_unl_batch, names['generated_data_unl_all_' + str(i)]), axis=0)
-            else:
-                x_unl_all = np.concatenate((x_unl_all, names['generated_data_unl_all_' + str(i)]), axis=0)
-
-        x_all = np.concatenate((x_unl_all, x_out_all), axis=0)
-        y_all = np.array([1] * (int(data_unl_batch.shape[0])) + [0] * (x_all.shape[0] - data_unl_batch.shape[0]))
-        discriminator_all_loss = discriminator_all.train_on_batch(x_all, y_all)
+        with timer.phase('final_discriminator'):
+            data_out_batch = np.concatenate(data_out_batches, axis=0)
+            data_unl_batch = np.concatenate(data_unl_batches, axis=0)
+            generated_data_out_all = gans_out.generate(out_all_sizes, noise=noise_out_all)
+            generated_data_unl_all = gans_unl.generate(unl_all_sizes, noise=noise_unl_all)
+            x_out_all = np.concatenate([data_out_batch] + generated_data_out_all, axis=0)
+            x_unl_all = np.concatenate([data_unl_batch] + generated_data_unl_all, axis=0)
+
+            x_all = np.concatenate((x_unl_all, x_out_all), axis=0)
+            y_all = np.array([1] * (int(data_unl_batch.shape[0])) + [0] * (x_all.shape[0] - data_unl_batch.shape[0]))
+            discriminator_all_loss = discriminator_all.train_on_batch(x_all, y_all)
 
         # The selection of optimal model
-        eva_x = discriminator_all.predict(data_x)
-        eva_x = pd.DataFrame(eva_x)
-        eva_y = np.array([0] * (int(data_out_x.shape[0])) + [1] * (data_unl_x.shape[0]))
-        eva_y = pd.DataFrame(eva_y)
-        eva_xy = np.concatenate((eva_x, eva_y), axis=1)
-        eva_xy = pd.DataFrame(eva_xy, columns=['x', 'y'])
-        eva_xy = eva_xy.sort_values('x', ascending=True)
-        eva_xy = eva_xy.as_matrix()
-        eva = 0
-        for i in range(eva_xy.shape[0]):
-            if eva_xy[i, 1] == 0:
-                eva = eva + i + 1
-        eva = eva / (data_x.shape[0] * data_out_x.shape[0])
-        eva_list.append(eva)
-        if eva_save >= eva:
-            eva_save = eva
-            discriminator_all.save('discriminator.h5')
+        with timer.phase('evaluation'):
+            eva = selector.update(epoch)
+        if eva is not None:
+            eva_list.append(eva)
+        with timer.phase('checkpoint'):
+            selector.checkpoint(epoch)
 
 
         if stop_iter == epochs:
             stop_iter = max(stop_iter_all)
         else:
-            for i in range(k_unl):
-                names['stop_unl_' + str(i)] = 1
+            stop_unl[:] = 1
 
         # 评估并保存检测结果
+        auc = None
         if epoch % 100 == 0:
-            p_value = discriminator_all.predict(data_x)
-            p_value = pd.DataFrame(p_value)
-            data_y = pd.DataFrame(data_y)
-            result = np.concatenate((p_value, data_y), axis=1)
-            result = pd.DataFrame(result, columns=['p', 'y'])
-            result = result.sort_values('p', ascending=True)
-
-            inlier_parray = result.loc[lambda df: df.y == 0, 'p'].values
-            outlier_parray = result.loc[lambda df: df.y == 1, 'p'].values
-            sum = 0.0
-            for o in outlier_parray:
-                for i in inlier_parray:
-                    if o < i:
-                        sum += 1.0
-                    elif o == i:
-                        sum += 0.5
-                    else:
-                        sum += 0
-            AUC = '{:.4f}'.format(sum / (len(inlier_parray) * len(outlier_parray)))
+            with timer.phase('evaluation'):
+                p_value = discriminator_all.predict(data_x)
+                auc = metrics.auc_score(p_value, data_y)
+            AUC = '{:.4f}'.format(auc)
             print('AUC:{}'.format(AUC))
 
+        # Checkpoint the training state, the copies are taken here and written in the background
+        if writer is not None and (epoch + 1) % args.state_every == 0 and epoch + 1 < epochs:
+            with timer.phase('checkpoint'):
+                writer.submit({'epoch': epoch + 1,
+                               'partition': {'clu_out': clu_out, 'k_out': k_out, 'clu_unl': clu_unl, 'k_unl': k_unl, 'rows_out': rows_out, 'rows_unl': rows_unl},
+                               'gans_out': gans_out.get_state(), 'gans_unl': gans_unl.get_state(),
+                               'discriminator_all': discriminator_all.get_weights(), 'discriminator_all_optimizer': discriminator_all.optimizer.get_weights(),
+                               'selector': selector.get_state(), 'sampler_out': sampler_states[0], 'sampler_unl': sampler_states[1],
+                               'stop_out': stop_out.copy(), 'stop_unl': stop_unl.copy(), 'stop_iter': stop_iter, 'stop_iter_all': stop_iter_all.copy(),
+                               'eva_list': list(eva_list), 'np_random': np.random.get_state()})
+
+        timer.end_epoch(epoch, d_loss=discriminator_all_loss[0], d_acc=discriminator_all_loss[1],
+                        out_d_loss=out_losses[0], out_g_loss=out_losses[1], unl_d_loss=unl_losses[0], unl_g_loss=unl_losses[1],
+                        active_out=int(np.sum(active_out)), stopped_out=int(k_out - np.sum(active_out)),
+                        active_unl=int(np.sum(active_unl)), stopped_unl=int(k_unl - np.sum(active_unl)),
+                        eva=eva, auc=auc)
+
+    if writer is not None:
+        writer.close()
+    if args.workers > 0:
+        pool.close()
+
+    # Keep the optimal model, also exported for NumPy inference
+    selector.restore()
+    with timer.phase('checkpoint'):
+        selector.save()
+        inference.export_discriminator(discriminator_all, 'discriminator.npz')
+
     # Test result
     data_x, data_id, data_y = load_test_data()
-    discriminator_all = load_model('discriminator.h5')
     p_value = discriminator_all.predict(data_x)
-    p_value = pd.DataFrame(p_value)
-    data_y = pd.DataFrame(data_y)
-    result = np.concatenate((p_value, data_y), axis=1)
-    result = pd.DataFrame(result, columns=['p', 'y'])
-    result = result.sort_values('p', ascending=True)
-
-    inlier_parray = result.loc[lambda df: df.y == 0, 'p'].values
-    outlier_parray = result.loc[lambda df: df.y == 1, 'p'].values
-    sum = 0.0
-    for o in outlier_parray:
-        for i in inlier_parray:
-            if o < i:
-                sum += 1.0
-            elif o == i:
-                sum += 0.5
-            else:
-                sum += 0
-    test_result = '{:.4f}'.format(sum / (len(inlier_parray) * len(outlier_parray)))
+    test_result = '{:.4f}'.format(metrics.auc_score(p_value, data_y))
     print('test_result:{}'.format(test_result))
+    precision = '{:.4f}'.format(metrics.precision_at_k(p_value, data_y, int(np.sum(data_y == 1))))
+    print('precision@{}:{}'.format(int(np.sum(data_y == 1)), precision))
+    timer.write_phases('test', auc=float(test_result), precision=float(precision))
+    timer.close()
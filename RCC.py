@@ -1,12 +1,345 @@
 import math
+import multiprocessing
+import time
+import traceback
 
 import numpy as np
 import scipy.sparse
 import scipy.sparse.linalg
 
 from scipy.sparse import csr_matrix, triu, find
-from scipy.sparse.csgraph import minimum_spanning_tree, connected_components
-from scipy.spatial import distance
+from scipy.sparse.csgraph import minimum_spanning_tree, connected_components, reverse_cuthill_mckee
+from scipy.spatial import distance, cKDTree
+
+import cache
+
+
+class GraphLaplacian:
+    """
+    The matrices A = D - R and M = I + lambda * A of equation [7], stored in CSR format with a fixed sparsity pattern.
+    The pattern of R never changes during the optimization, only the edge weights do. The position of every edge and
+    diagonal entry in the CSR data arrays is computed once, so updating the weights is a single vectorized scatter
+    into preallocated arrays.
+
+    Parameters
+    ----------
+    i (array) first node of each edge
+    j (array) second node of each edge. Edges are undirected, listed once and never join a node to itself
+    n_samples (int) number of nodes
+    """
+
+    def __init__(self, i, j, n_samples):
+
+        self.i = i
+        self.j = j
+        self.n_samples = n_samples
+
+        diag = np.arange(n_samples)
+        rows = np.concatenate([i, j, diag], axis=0)
+        cols = np.concatenate([j, i, diag], axis=0)
+
+        # store the index of every entry as its value to find where the conversion to CSR puts it
+        pattern = csr_matrix((np.arange(1, rows.shape[0] + 1, dtype=np.float64), (rows, cols)),
+                             shape=(n_samples, n_samples))
+        self._slots = np.empty((rows.shape[0],), dtype=np.int64)
+        self._slots[pattern.data.astype(np.int64) - 1] = np.arange(rows.shape[0])
+        self._diag_slots = self._slots[2 * i.shape[0]:]
+
+        self._eye = np.zeros((rows.shape[0],))
+        self._eye[self._diag_slots] = 1.0
+
+        self.A = csr_matrix((np.zeros((rows.shape[0],)), pattern.indices, pattern.indptr), shape=(n_samples, n_samples))
+        self.M = csr_matrix((np.zeros((rows.shape[0],)), pattern.indices, pattern.indptr), shape=(n_samples, n_samples))
+        self.degree = np.zeros((n_samples,))
+
+    def update(self, weights):
+        """
+        Sets the edge weights of R and refreshes A = D - R in place.
+
+        Parameters
+        ----------
+        weights (array) weight of each edge
+        """
+
+        self.degree = np.bincount(self.i, weights, self.n_samples) + np.bincount(self.j, weights, self.n_samples)
+        self.A.data[self._slots] = np.concatenate([-weights, -weights, self.degree], axis=0)
+
+        return self.A
+
+    def system(self, lambda_):
+        """
+        Refreshes M = I + lambda * A in place from the current A.
+
+        Parameters
+        ----------
+        lambda_ (float) term balancing the contributions of the losses
+        """
+
+        np.multiply(self.A.data, lambda_, out=self.M.data)
+        self.M.data += self._eye
+
+        return self.M
+
+
+def weak_blocks(M, n_blocks, cutoff=1e-2):
+    """
+    Splits the nodes of M = I + lambda * A into n_blocks blocks of similar size that cut few strong couplings. The
+    coupling of two nodes is |M_pq| / sqrt(M_pp M_qq); the couplings below cutoff, the connections lpq has turned
+    off, are dropped, and the nodes are ordered by reverse Cuthill-McKee on the remaining graph. That order keeps every
+    connected component together and neighbours close, so contiguous chunks of it share few edges.
+
+    Parameters
+    ----------
+    M (sparse matrix) symmetric matrix of shape (n_samples, n_samples)
+    n_blocks (int) number of blocks
+    cutoff (float) couplings below cutoff do not hold the blocks together
+
+    Returns
+    -------
+    blocks (list) sorted node indices of every block
+    """
+
+    M = M.tocoo()
+    diag = M.diagonal()
+    strong = (M.row != M.col) & (np.abs(M.data) >= cutoff * np.sqrt(diag[M.row] * diag[M.col]))
+    graph = csr_matrix((np.ones((np.sum(strong),)), (M.row[strong], M.col[strong])), shape=M.shape)
+
+    order = reverse_cuthill_mckee(graph, symmetric_mode=True)
+    return [np.sort(block) for block in np.array_split(order, min(n_blocks, M.shape[0])) if block.shape[0] > 0]
+
+
+def merge_clusters(U, labels, min_size=1, max_clusters=None, sizes=None):
+    """
+    Merges small clusters into their nearest neighbour until every cluster has at least min_size rows and at most
+    max_clusters clusters remain. The smallest cluster is merged first, into the cluster with the closest centroid of
+    representatives, and the centroid of the merged cluster is updated.
+
+    Parameters
+    ----------
+    U (array) representatives of the rows, 2d numpy array of shape (n_samples, n_features)
+    labels (array) cluster of each representative, integers in [0, n_clusters)
+    min_size (int) minimum number of rows of a cluster
+    max_clusters (int) maximum number of clusters, no maximum if None
+    sizes (array) number of rows of each cluster, the counts of labels if None, e.g. when U holds a subsample; its
+        length is the number of clusters, some of which may have no representative
+
+    Returns
+    -------
+    mapping (array) new cluster of each cluster, mapping[labels] relabels the rows
+    n_clusters (int) number of clusters after merging
+    """
+
+    labels = np.asarray(labels).ravel()
+    n_clusters = int(np.max(labels)) + 1 if sizes is None else len(sizes)
+    if sizes is None:
+        sizes = np.bincount(labels, minlength=n_clusters)
+    sizes = np.asarray(sizes, dtype=np.float64).copy()
+    centroids = np.zeros((n_clusters, U.shape[1]))
+    np.add.at(centroids, labels, U)
+    counts = np.bincount(labels, minlength=n_clusters).astype(np.float64)
+    centroids /= np.maximum(counts, 1)[:, None]
+
+    parent = np.arange(n_clusters)
+    alive = np.ones((n_clusters,), dtype=bool)
+    if max_clusters is None:
+        max_clusters = n_clusters
+    max_clusters = max(1, max_clusters)
+
+    while np.sum(alive) > 1:
+        smallest = np.flatnonzero(alive)[np.argmin(sizes[alive])]
+        if sizes[smallest] >= min_size and np.sum(alive) <= max_clusters:
+            break
+
+        others = np.flatnonzero(alive & (np.arange(n_clusters) != smallest))
+        target = others[np.argmin(np.sum((centroids[others] - centroids[smallest]) ** 2, axis=1))]
+
+        total = counts[target] + counts[smallest]
+        centroids[target] = (counts[target] * centroids[target] + counts[smallest] * centroids[smallest]) / max(total, 1)
+        counts[target] = total
+        sizes[target] += sizes[smallest]
+        alive[smallest] = False
+        parent[parent == smallest] = target
+
+    # number the remaining clusters from 0, in their original order
+    new_ids = np.cumsum(alive) - 1
+    return new_ids[parent], int(np.sum(alive))
+
+
+def _block_worker(conn):
+    """
+    Worker loop of a BlockSolverPool: factorizes the diagonal blocks it receives and solves with them. A message is
+    ('factor', [(key, block matrix)]) or ('solve', [(key, right-hand sides)]), answered with the list of results.
+    """
+
+    factors = {}
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        try:
+            command, items = message
+            if command == 'factor':
+                factors = dict((key, scipy.sparse.linalg.splu(block.tocsc())) for key, block in items)
+                conn.send(([None] * len(items), None))
+            else:
+                conn.send(([factors[key].solve(r) for key, r in items], None))
+        except Exception:
+            conn.send((None, traceback.format_exc()))
+
+
+class BlockSolverPool:
+    """
+    Block Jacobi preconditioner of M = I + lambda * A whose diagonal blocks are factorized and solved in worker
+    processes, one group of blocks per worker. The workers are spawned, forking a process that may hold a deep learning
+    backend is unsafe.
+
+    Parameters
+    ----------
+    n_workers (int) number of worker processes, the blocks are solved in the calling process if 0
+    """
+
+    def __init__(self, n_workers):
+
+        self.n_workers = n_workers
+        self._conns = []
+        self._processes = []
+        if n_workers > 0:
+            context = multiprocessing.get_context('spawn')
+            for _ in range(n_workers):
+                parent, child = context.Pipe()
+                process = context.Process(target=_block_worker, args=(child,))
+                process.daemon = True
+                process.start()
+                self._conns.append(parent)
+                self._processes.append(process)
+        self.blocks = []
+        self._factors = {}
+
+    def _call(self, command, items):
+        """
+        Sends the items of every block to the worker holding it and returns the results in the order of the blocks.
+        """
+
+        n_workers = len(self._conns)
+        for worker, conn in enumerate(self._conns):
+            conn.send((command, items[worker::n_workers]))
+
+        results = [None] * len(items)
+        errors = []
+        for worker, conn in enumerate(self._conns):
+            result, error = conn.recv()
+            if error is not None:
+                errors.append(error)
+                continue
+            results[worker::n_workers] = result
+        if errors:
+            raise RuntimeError('block solver worker failed:\n{}'.format(errors[0]))
+
+        return results
+
+    def factor(self, M, blocks):
+        """
+        Factorizes the diagonal blocks of M.
+
+        Parameters
+        ----------
+        M (sparse matrix) symmetric positive definite matrix
+        blocks (list) node indices of every block, see weak_blocks
+        """
+
+        M = M.tocsr()
+        self.blocks = blocks
+        items = [(b, M[block][:, block]) for b, block in enumerate(blocks)]
+        if self._conns:
+            self._call('factor', items)
+        else:
+            self._factors = dict((b, scipy.sparse.linalg.splu(block.tocsc())) for b, block in items)
+
+    def solve(self, R):
+        """
+        Applies the inverse of the block diagonal of M to a block of vectors.
+
+        Parameters
+        ----------
+        R (array) 2d numpy array of shape (n_samples, n_features)
+        """
+
+        items = [(b, np.ascontiguousarray(R[block])) for b, block in enumerate(self.blocks)]
+        if self._conns:
+            results = self._call('solve', items)
+        else:
+            results = [self._factors[b].solve(r) for b, r in items]
+
+        Z = np.empty_like(R)
+        for block, z in zip(self.blocks, results):
+            Z[block] = z
+        return Z
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None)
+        for process in self._processes:
+            process.join()
+        self._conns = []
+        self._processes = []
+
+
+class SpectralNormEstimator:
+    """
+    Estimates the largest eigenvalue of a graph Laplacian A = D - R, used to set lambda in equation [9]. A is symmetric
+    positive semidefinite, so its largest eigenvalue is also its spectral norm.
+
+    Every estimate is appended to history with its method, value, wall time in seconds and accuracy: for 'lanczos' and
+    'arpack' the residual norm ||A v - value v|| of the returned eigenvector (the value is within this distance of an
+    eigenvalue of A), for 'gershgorin' the width of the interval [max diagonal entry, bound] containing the eigenvalue.
+
+    Parameters
+    ----------
+    method (string) 'lanczos' for the symmetric Lanczos solver warm-started from the previous eigenvector, 'gershgorin'
+        for the Gershgorin upper bound (no iterations, makes lambda smaller) or 'arpack' for the general non-symmetric
+        solver
+    tol (float) relative tolerance of the Lanczos and ARPACK solvers
+    """
+
+    def __init__(self, method='lanczos', tol=1e-6):
+
+        self.method = method
+        self.tol = tol
+
+        self.v0 = None
+        self.history = []
+
+    def estimate(self, A):
+        """
+        Returns the largest eigenvalue of A, or an upper bound of it for the 'gershgorin' method.
+
+        Parameters
+        ----------
+        A (sparse matrix) symmetric positive semidefinite matrix
+        """
+
+        start = time.time()
+
+        if self.method == 'gershgorin':
+            abs_A = abs(A)
+            value = np.max(np.asarray(abs_A.sum(axis=1)))
+            accuracy = value - np.max(A.diagonal())
+        elif self.method in ('lanczos', 'arpack'):
+            if self.method == 'lanczos':
+                vals, vecs = scipy.sparse.linalg.eigsh(A, k=1, which='LA', v0=self.v0, tol=self.tol)
+                self.v0 = vecs[:, 0]
+            else:
+                vals, vecs = scipy.sparse.linalg.eigs(A, k=1, tol=self.tol)
+                vals, vecs = vals.real, vecs.real
+            value = vals[0]
+            accuracy = np.linalg.norm(A.dot(vecs[:, 0]) - value * vecs[:, 0])
+        else:
+            raise ValueError('unknown eigenvalue method: {}'.format(self.method))
+
+        self.history.append({'method': self.method, 'value': float(value), 'seconds': time.time() - start,
+                             'accuracy': float(accuracy)})
+
+        return value
 
 
 class RccCluster:
@@ -21,45 +354,113 @@ class RccCluster:
     clustering_threshold (float) threshold to assign points together in a cluster. Higher means fewer larger clusters
     eps (float) numerical epsilon used for computation
     verbose (boolean) verbosity
+    memory_budget (float) memory budget in megabytes for the pairwise distances of the mutual kNN construction
+    knn_algorithm (string) one of 'auto', 'brute' or 'kd_tree', see m_knn
+    solver (string) linear solver for the U update, 'spsolve' (exact, direct), 'cg' (preconditioned conjugate
+        gradient warm-started from the previous U, falls back to spsolve if it does not converge) or 'partitioned'
+        (cg preconditioned by the exact solves of weakly coupled blocks, see weak_blocks, run on n_jobs processes)
+    preconditioner (string) preconditioner of the 'cg' solver, 'jacobi' or 'ilu'
+    tol (float) relative residual tolerance of the 'cg' solver
+    cg_max_iter (int) maximum number of conjugate gradient iterations per U update
+    max_components (int) the assignment threshold grows until at most this many clusters remain
+    eig_method (string) estimator of the largest eigenvalue of D - R, see SpectralNormEstimator
+    cache (RccCache) optional on-disk cache of the results of fit, see cache.RccCache
+    subsample (int) if set, fit runs RCC on at most this many rows and assigns the others with predict
+    n_jobs (int) number of blocks and worker processes of the 'partitioned' solver, solved in process if 1
+    random_state (int) seed of the subsample
     """
 
-    def __init__(self, k=10, measure='euclidean', clustering_threshold = 1, eps=1e-5, verbose=True):
+    def __init__(self, k=10, measure='euclidean', clustering_threshold = 1, eps=1e-5, verbose=True,
+                 memory_budget=512, knn_algorithm='auto', solver='spsolve', preconditioner='jacobi', tol=1e-5,
+                 cg_max_iter=500, max_components=20, eig_method='lanczos', cache=None,
+                 subsample=None, random_state=None, n_jobs=1):
 
         self.k = k
         self.measure = measure
         self.clustering_threshold = clustering_threshold
         self.eps = eps
         self.verbose = verbose
+        self.memory_budget = memory_budget
+        self.knn_algorithm = knn_algorithm
+        self.solver = solver
+        self.preconditioner = preconditioner
+        self.tol = tol
+        self.cg_max_iter = cg_max_iter
+        self.max_components = max_components
+        self.eig_method = eig_method
+        self.cache = cache
+        self.subsample = subsample
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self._block_pool = None
 
         self.labels_ = None
+        self.representative_labels_ = None
+        self.sample_indices_ = None
         self.U = None
         self.i = None
         self.j = None
         self.n_samples = None
+        self.merge_distances_ = None
+        self.threshold_curve_ = None
+        self.eig_history_ = None
+        self.timings_ = {}
 
     def compute_assignment(self, epsilon):
         """
         Assigns points to clusters based on their representative. Two points are part of the same cluster if their
-        representative are close enough (their squared euclidean distance is < delta)
+        representative are close enough (their euclidean distance is <= clustering_threshold * m * epsilon). m grows from
+        1 to 99 until at most max_components clusters remain.
+
+        The edge lengths are computed and sorted once. Merging the edges with union-find in increasing length order
+        (Kruskal, which is what minimum_spanning_tree runs) gives a spanning forest: at any threshold, every forest edge
+        no longer than the threshold merges two components, so one sweep yields the component count at all thresholds.
         """
-        for m in range(1, 100, 1):
-            diff = np.sum((self.U[self.i, :] - self.U[self.j, :]) ** 2, axis=1)
+        diff = np.sqrt(np.sum((self.U[self.i, :] - self.U[self.j, :]) ** 2, axis=1))
 
-            # computing connected components.
-            is_conn = np.sqrt(diff) <= self.clustering_threshold * m * epsilon
-            print(m)
-            G = scipy.sparse.coo_matrix((np.ones((2 * np.sum(is_conn),)),
-                                         (np.concatenate([self.i[is_conn], self.j[is_conn]], axis=0),
-                                          np.concatenate([self.j[is_conn], self.i[is_conn]], axis=0))),
-                                        shape=[self.n_samples, self.n_samples])
+        # use the ranks of the lengths as weights: the order is kept exactly and no edge has a zero weight, which
+        # scipy would treat as a missing edge
+        order = np.argsort(diff, kind='mergesort')
+        rank = np.empty(order.shape[0])
+        rank[order] = np.arange(1, order.shape[0] + 1)
+        forest = minimum_spanning_tree(scipy.sparse.coo_matrix((rank, (self.i, self.j)),
+                                                               shape=[self.n_samples, self.n_samples])).tocoo()
+        forest_len = diff[order[forest.data.astype(np.int64) - 1]]
 
-            num_components, labels = connected_components(G, directed=False)
-            if num_components <=20:
-                print(m)
-                print(num_components)
-                return labels, num_components
-                break
+        self.merge_distances_ = np.sort(forest_len)
 
+        thresholds = self.clustering_threshold * np.arange(1, 100) * epsilon
+        counts = self.n_samples - np.searchsorted(self.merge_distances_, thresholds, side='right')
+        self.threshold_curve_ = np.stack([thresholds, counts], axis=1)
+
+        # take the first threshold reaching the component cap, or the largest one if none does
+        below_cap = np.flatnonzero(counts <= self.max_components)
+        m = below_cap[0] if below_cap.shape[0] > 0 else thresholds.shape[0] - 1
+
+        # computing connected components.
+        is_conn = forest_len <= thresholds[m]
+        G = scipy.sparse.coo_matrix((np.ones((np.sum(is_conn),)), (forest.row[is_conn], forest.col[is_conn])),
+                                    shape=[self.n_samples, self.n_samples])
+        num_components, labels = connected_components(G, directed=False)
+
+        if self.verbose:
+            print('m = {}, number of components = {}'.format(m + 1, num_components))
+
+        return labels, num_components
+
+    def component_curve(self):
+        """
+        Returns the number of connected components as a function of the assignment threshold, computed by the last
+        call to compute_assignment. The count drops by one at each returned threshold.
+
+        Returns
+        -------
+        thresholds (array) sorted distances at which two components merge
+        counts (array) number of components once the distance threshold reaches the corresponding value
+        """
+
+        counts = self.n_samples - np.arange(1, self.merge_distances_.shape[0] + 1)
+        return self.merge_distances_, counts
 
     @staticmethod
     def geman_mcclure(data, mu):
@@ -104,46 +505,206 @@ class RccCluster:
         return obj
 
     @staticmethod
-    def m_knn(X, k, measure='euclidean'):
+    def block_pcg(M, B, X0, precond, tol=1e-5, max_iter=500):
         """
-        This code is taken from:
-        https://bitbucket.org/sohilas/robust-continuous-clustering/src/
-        The original terms of the license apply.
-        Construct mutual_kNN for large scale dataset
+        Preconditioned conjugate gradient for a symmetric positive definite M, run on all columns of B at once. Each
+        column keeps its own step sizes, so the result equals solving the columns one by one, but every iteration costs a
+        single sparse matrix product with a block of vectors.
 
-        If j is one of i's closest neighbors and i is also one of j's closest members,
-        the edge will appear once with (i,j) where i < j.
+        Parameters
+        ----------
+        M (sparse matrix) symmetric positive definite matrix of shape (n_samples, n_samples)
+        B (array) right-hand sides, 2d numpy array of shape (n_samples, n_features)
+        X0 (array) initial guess with the same shape as B
+        precond (callable) applies the inverse of the preconditioner to a block of vectors
+        tol (float) relative residual tolerance, per column
+        max_iter (int) maximum number of iterations
+
+        Returns
+        -------
+        X (array) approximate solution
+        converged (boolean) whether all the columns reached the tolerance
+        """
+
+        X = np.array(X0, dtype=np.float64)
+        R = B - M.dot(X)
+        Z = precond(R)
+        P = Z.copy()
+        rz = np.sum(R * Z, axis=0)
+
+        b_norm = np.linalg.norm(B, axis=0)
+        b_norm[b_norm == 0] = 1.0
+
+        for _ in range(max_iter):
+            active = np.linalg.norm(R, axis=0) > tol * b_norm
+            if not np.any(active):
+                return X, True
+
+            MP = M.dot(P)
+            pmp = np.sum(P * MP, axis=0)
+
+            # converged columns are frozen by a zero step
+            alpha = np.where(active, rz / np.where(active, pmp, 1.0), 0.0)
+            X += alpha * P
+            R -= alpha * MP
+
+            Z = precond(R)
+            rz_new = np.sum(R * Z, axis=0)
+            beta = np.where(active, rz_new / np.where(active, rz, 1.0), 0.0)
+            P = Z + beta * P
+            rz = rz_new
+
+        return X, bool(np.all(np.linalg.norm(R, axis=0) <= tol * b_norm))
+
+    def solve_u(self, M, X, U):
+        """
+        Solves M U = X for the representatives, see equation [7].
+
+        Parameters
+        ----------
+        M (sparse matrix) the matrix I + lambda (D - R)
+        X (array) data points, 2d numpy array of shape (n_samples, n_features)
+        U (array) current representatives, used as the initial guess of the iterative solver
+        """
+
+        if self.solver == 'spsolve':
+            return scipy.sparse.linalg.spsolve(M, X)
+
+        if self.solver not in ('cg', 'partitioned'):
+            raise ValueError('unknown solver: {}'.format(self.solver))
+
+        M = M.tocsr()
+        if self.solver == 'partitioned' and self._block_pool is not None:
+            # the blocks follow the current lpq, the boundary couplings are reconciled by the outer conjugate gradient
+            self._block_pool.factor(M, weak_blocks(M, max(1, self.n_jobs)))
+            precond = self._block_pool.solve
+        elif self.preconditioner == 'jacobi':
+            inv_diag = 1.0 / M.diagonal()
+            precond = lambda r: inv_diag[:, None] * r
+        elif self.preconditioner == 'ilu':
+            # scipy ships no incomplete Cholesky, ILU on the symmetric matrix is the closest available factorisation
+            ilu = scipy.sparse.linalg.spilu(M.tocsc(), drop_tol=1e-4, fill_factor=10)
+            precond = ilu.solve
+        else:
+            raise ValueError('unknown preconditioner: {}'.format(self.preconditioner))
+
+        U, converged = self.block_pcg(M, np.asarray(X, dtype=np.float64), U, precond, self.tol, self.cg_max_iter)
+        if not converged:
+            if self.verbose:
+                print('cg did not converge in {} iterations, using spsolve'.format(self.cg_max_iter))
+            return scipy.sparse.linalg.spsolve(M.tocsc(), X)
+
+        return U
+
+    @staticmethod
+    def _knn_brute(X, k, measure, memory_budget):
+        """
+        Exact k nearest neighbours computed tile by tile, so that no more than memory_budget megabytes of distances
+        are held at once. A running buffer of the k + 1 closest candidates is kept for every row of a block and merged
+        with each new tile of columns.
 
         Parameters
         ----------
         X (array) 2d array of data of shape (n_samples, n_dim)
         k (int) number of neighbors for each sample in X
         measure (string) distance metric, one of 'cosine' or 'euclidean'
+        memory_budget (float) memory budget in megabytes for one tile of distances and its partition indices
         """
 
         samples = X.shape[0]
-        batch_size = 1000000
-        b = np.arange(k + 1)
-        b = tuple(b[1:].ravel())
 
-        z = np.zeros((samples, k))
-        weigh = np.zeros_like(z)
+        # every tile entry costs a float64 distance, its int64 candidate index and the int64 index from argpartition
+        tile_size = max(int(memory_budget * 2 ** 20) // 24, (k + 1) ** 2)
+        col_batch = min(samples, max(k + 1, tile_size // min(samples, 256)))
+        row_batch = max(1, min(samples, tile_size // col_batch))
+
+        z = np.zeros((samples, k), dtype=np.int64)
+        weigh = np.zeros((samples, k))
 
         # This loop speeds up the computation by operating in batches
         # This can be parallelized to further utilize CPU/GPU resource
 
-        for x in np.arange(0, samples, batch_size):
-            start = x
-            end = min(x + batch_size, samples)
+        for start in range(0, samples, row_batch):
+            end = min(start + row_batch, samples)
+            rows = np.arange(end - start)[:, None]
+
+            best_d = np.full((end - start, 0), np.inf)
+            best_i = np.zeros((end - start, 0), dtype=np.int64)
+
+            for col_start in range(0, samples, col_batch):
+                col_end = min(col_start + col_batch, samples)
+
+                w = distance.cdist(X[start:end], X[col_start:col_end], measure)
+                cand_d = np.concatenate([best_d, w], axis=1)
+                cand_i = np.concatenate([best_i, np.broadcast_to(np.arange(col_start, col_end),
+                                                                 w.shape)], axis=1)
+                del w
+
+                if cand_d.shape[1] > k + 1:
+                    y = np.argpartition(cand_d, k, axis=1)[:, :k + 1]
+                    cand_d = cand_d[rows, y]
+                    cand_i = cand_i[rows, y]
+
+                best_d, best_i = cand_d, cand_i
+
+            # the closest candidate is the sample itself
+            y = np.argsort(best_d, axis=1)
+            z[start:end, :] = best_i[rows, y[:, 1:k + 1]]
+            weigh[start:end, :] = best_d[rows, y[:, 1:k + 1]]
+
+        return z, weigh
+
+    @staticmethod
+    def _knn_tree(X, k):
+        """
+        Exact euclidean k nearest neighbours through a KD-tree index. Memory grows linearly with the number of samples.
+
+        Parameters
+        ----------
+        X (array) 2d array of data of shape (n_samples, n_dim)
+        k (int) number of neighbors for each sample in X
+        """
+
+        tree = cKDTree(X)
+        weigh, z = tree.query(X, k=k + 1)
+
+        # the closest candidate is the sample itself
+        return z[:, 1:].astype(np.int64), weigh[:, 1:]
+
+    @staticmethod
+    def m_knn(X, k, measure='euclidean', memory_budget=512, algorithm='auto'):
+        """
+        This code is taken from:
+        https://bitbucket.org/sohilas/robust-continuous-clustering/src/
+        The original terms of the license apply.
+        Construct mutual_kNN for large scale dataset
+
+        If j is one of i's closest neighbors and i is also one of j's closest members,
+        the edge will appear once with (i,j) where i < j.
+
+        Parameters
+        ----------
+        X (array) 2d array of data of shape (n_samples, n_dim)
+        k (int) number of neighbors for each sample in X
+        measure (string) distance metric, one of 'cosine' or 'euclidean'
+        memory_budget (float) memory budget in megabytes for the pairwise distances held at once
+        algorithm (string) one of 'brute', 'kd_tree' or 'auto'. 'kd_tree' is only available for the euclidean
+            measure, 'auto' picks it for euclidean data with few dimensions.
+        """
 
-            w = distance.cdist(X[start:end], X, measure)
+        samples = X.shape[0]
 
-            y = np.argpartition(w, b, axis=1)
+        if algorithm == 'auto':
+            algorithm = 'kd_tree' if measure == 'euclidean' and X.shape[1] <= 16 else 'brute'
 
-            z[start:end, :] = y[:, 1:k + 1]
-            weigh[start:end, :] = np.reshape(w[tuple(np.repeat(np.arange(end - start), k)),
-                                               tuple(y[:, 1:k + 1].ravel())], (end - start, k))
-            del w
+        if algorithm == 'kd_tree':
+            if measure != 'euclidean':
+                raise ValueError('kd_tree neighbours are only available for the euclidean measure')
+            z, weigh = RccCluster._knn_tree(X, k)
+        elif algorithm == 'brute':
+            z, weigh = RccCluster._knn_brute(X, k, measure, memory_budget)
+        else:
+            raise ValueError('unknown kNN algorithm: {}'.format(algorithm))
 
         ind = np.repeat(np.arange(samples), k)
 
@@ -169,6 +730,8 @@ class RccCluster:
         inner_iter (int) number of inner iterations. 4 works well in most cases.
         """
 
+        start = time.time()
+
         X = X.astype(np.float32)  # features stacked as N x D (D is the dimension)
 
         w = w.astype(np.int32)  # list of edges represented by start and end nodes
@@ -188,20 +751,14 @@ class RccCluster:
 
         # set the weights as given in equation [S1] (supplementary information), making sure to exploit the data
         # sparsity
-        R = scipy.sparse.coo_matrix((np.ones((i.shape[0] * 2,)),
-                                     (np.concatenate([i, j], axis=0),
-                                      np.concatenate([j, i], axis=0))), shape=[n_samples, n_samples])
+        laplacian = GraphLaplacian(i, j, n_samples)
 
         # number of connections
-        n_conn = np.sum(R, axis=1)
-
-        # make sure to convert back to a numpy array from a numpy matrix, since the output of the sum() operation on a
-        # sparse matrix is a numpy matrix
-        n_conn = np.asarray(n_conn)
+        laplacian.update(np.ones((i.shape[0],)))
+        n_conn = laplacian.degree
 
         # equation [S1]
         weights = np.mean(n_conn) / np.sqrt(n_conn[i] * n_conn[j])
-        weights = weights[:, 0]  # squueze out the unnecessary dimension
 
         # initializing the representatives U to have the same value as X
         U = X.copy()
@@ -229,21 +786,15 @@ class RccCluster:
 
         # computation of matrix A = D-R (here D is the diagonal matrix and R is the symmetric matrix), see equation (8)
 
-        R = scipy.sparse.coo_matrix((np.concatenate([weights * lpq, weights * lpq], axis=0),
-                                     (np.concatenate([i, j], axis=0), np.concatenate([j, i], axis=0))),
-                                    shape=[n_samples, n_samples])
-
-        D = scipy.sparse.coo_matrix((np.squeeze(np.asarray(np.sum(R, axis=1))),
-                                     ((range(n_samples), range(n_samples)))),
-                                    (n_samples, n_samples))
+        A = laplacian.update(weights * lpq)
 
         # initial computation of lambda (lambda is a reserved keyword in python)
-        # note: compute the largest magnitude eigenvalue instead of the matrix norm as it is faster to compute
-
-        eigval = scipy.sparse.linalg.eigs(D - R, k=1, return_eigenvectors=False).real
+        # note: A is symmetric positive semidefinite, its largest eigenvalue is its matrix norm
+        spectral = SpectralNormEstimator(method=self.eig_method)
+        self.eig_history_ = spectral.history
 
         # lambda is a reserved keyword in python, so we use lambda_. Calculate lambda as per equation 9.
-        lambda_ = xi / eigval[0]
+        lambda_ = xi / spectral.estimate(A)
 
         if self.verbose:
             print('mu = {}, lambda = {}, epsilon = {}, delta = {}'.format(mu, lambda_, epsilon, delta))
@@ -254,58 +805,65 @@ class RccCluster:
 
         inner_iter_count = 0
 
-        # start of optimization phase
-
-        for iter_num in range(1, max_iter):
-
-            # update lpq. Equation 5.
-            lpq = self.geman_mcclure(U[i, :] - U[j, :], mu)
+        if self.solver == 'partitioned':
+            self._block_pool = BlockSolverPool(self.n_jobs if self.n_jobs > 1 else 0)
 
-            # compute objective. Equation 6.
-            obj[iter_num] = self.compute_obj(X, U, lpq, i, j, lambda_, mu, weights, iter_num)
+        # start of optimization phase
 
-            # update U. Equation 7. For efficiency we form sparse matrices R and D separately, then combine them.
+        try:
+            for iter_num in range(1, max_iter):
 
-            R = scipy.sparse.coo_matrix((np.concatenate([weights * lpq, weights * lpq], axis=0),
-                                         (np.concatenate([i, j], axis=0), np.concatenate([j, i], axis=0))),
-                                        shape=[n_samples, n_samples])
+                # update lpq. Equation 5.
+                lpq = self.geman_mcclure(U[i, :] - U[j, :], mu)
 
-            D = scipy.sparse.coo_matrix((np.asarray(np.sum(R, axis=1))[:, 0], ((range(n_samples), range(n_samples)))),
-                                        shape=(n_samples, n_samples))
+                # compute objective. Equation 6.
+                obj[iter_num] = self.compute_obj(X, U, lpq, i, j, lambda_, mu, weights, iter_num)
 
-            M = scipy.sparse.eye(n_samples) + lambda_ * (D - R)
+                # update U. Equation 7. The weights are scattered into the preallocated CSR matrices A and M.
+                A = laplacian.update(weights * lpq)
+                M = laplacian.system(lambda_)
 
-            # Solve for U. This could be further optimised through appropriate preconditioning.
-            U = scipy.sparse.linalg.spsolve(M, X)
+                # Solve for U, either exactly or iteratively starting from the previous U.
+                U = self.solve_u(M, X, U)
 
-            # check for stopping criteria
-            inner_iter_count += 1
+                # check for stopping criteria
+                inner_iter_count += 1
 
-            # check for the termination conditions and modulate delta if necessary.
-            if (abs(obj[iter_num - 1] - obj[iter_num]) < 1e-1) or inner_iter_count == inner_iter:
-                if mu >= delta:
-                    mu /= 2.0
-                elif inner_iter_count == inner_iter:
-                    mu = 0.5 * delta
-                else:
-                    break
+                # check for the termination conditions and modulate delta if necessary.
+                if (abs(obj[iter_num - 1] - obj[iter_num]) < 1e-1) or inner_iter_count == inner_iter:
+                    if mu >= delta:
+                        mu /= 2.0
+                    elif inner_iter_count == inner_iter:
+                        mu = 0.5 * delta
+                    else:
+                        break
 
-                eigval = scipy.sparse.linalg.eigs(D - R, k=1, return_eigenvectors=False).real
-                lambda_ = xi / eigval[0]
-                inner_iter_count = 0
+                    lambda_ = xi / spectral.estimate(A)
+                    inner_iter_count = 0
+        finally:
+            if self._block_pool is not None:
+                self._block_pool.close()
+                self._block_pool = None
 
         # at the end of the run, assign values to the class members.
         self.U = U.copy()
         self.i = i
         self.j = j
         self.n_samples = n_samples
+        self.timings_['rcc_solve'] = time.time() - start
+
+        start = time.time()
         C, num_components = self.compute_assignment(epsilon)
+        self.timings_['assignment'] = time.time() - start
 
         return U, C, num_components
 
     def fit(self, X):
         """
-        Computes the clustering and returns the labels
+        Computes the clustering and returns the labels. With subsample set and more rows than subsample, RCC runs on a
+        random subsample of the rows and the other rows get the cluster of their nearest representative, see predict.
+        The subsample is drawn in the canonical order of the rows, so it does not depend on their order.
+
         Parameters
         ----------
         X (array) numpy array of data to cluster with shape (n_samples, n_features)
@@ -314,15 +872,93 @@ class RccCluster:
         assert type(X) == np.ndarray
         assert len(X.shape) == 2
 
+        # the time spent in each phase is kept in timings_
+        self.timings_ = {}
+
+        if not self.subsample or X.shape[0] <= self.subsample:
+            self.sample_indices_ = None
+            labels, num_components = self._fit(X)
+            self.representative_labels_ = labels
+            self.labels_ = labels.copy()
+            return self.labels_, num_components
+
+        rng = np.random.RandomState(self.random_state)
+        order = cache.canonical_order(X)
+        self.sample_indices_ = np.sort(order[rng.choice(X.shape[0], self.subsample, replace=False)])
+        labels, num_components = self._fit(X[self.sample_indices_])
+        self.representative_labels_ = labels
+
+        start = time.time()
+        self.labels_ = self.predict(X)
+        self.labels_[self.sample_indices_] = labels
+        self.timings_['extend'] = time.time() - start
+
+        return self.labels_, num_components
+
+    def _fit(self, X):
+        """
+        Runs RCC on all the rows of X, or loads its result from the cache, and returns the labels.
+        """
+
         # compute the mutual knn graph
         print(min(X.shape[0], self.k))
-        mknn_matrix = self.m_knn(X, min(X.shape[0]-1, self.k), measure=self.measure)
+        start = time.time()
+
+        # skip RCC if the same rows, in any order, were clustered with the same parameters
+        if self.cache is not None:
+            order = cache.canonical_order(X)
+            key = self.cache.key(X, self, order)
+            entry = self.cache.load(key, order)
+            if entry is not None:
+                self.U = entry['U']
+                self.i = entry['i']
+                self.j = entry['j']
+                self.n_samples = X.shape[0]
+                self.timings_['cache'] = time.time() - start
+                if self.verbose:
+                    print('RCC result loaded from the cache, number of components = {}'.format(entry['num_components']))
+                return entry['labels'], entry['num_components']
+
+        mknn_matrix = self.m_knn(X, min(X.shape[0]-1, self.k), measure=self.measure,
+                                 memory_budget=self.memory_budget, algorithm=self.knn_algorithm)
+        self.timings_['mknn'] = time.time() - start
 
         # perform the RCC clustering
         U, C, num_components = self.run_rcc(X, mknn_matrix)
 
-        # store the class labels in the appropriate class member to match the sklearn.cluster interface
-        self.labels_ = C.copy()
+        if self.cache is not None:
+            self.cache.store(key, order, C, num_components, self.U, self.i, self.j)
 
-        # return the computed labels
-        return self.labels_, num_components
+        return C, num_components
+
+    def predict(self, X):
+        """
+        Assigns every row of X to the cluster of its nearest representative in U, under the measure of the clustering.
+        The rows are processed in chunks so that no more than memory_budget megabytes of distances are held at once.
+
+        Parameters
+        ----------
+        X (array) numpy array of data with shape (n_samples, n_features)
+
+        Returns
+        -------
+        labels (array) cluster of each row
+        """
+
+        if self.U is None:
+            raise ValueError('predict needs a fitted RccCluster')
+
+        U = self.U.astype(np.float64)
+        algorithm = self.knn_algorithm
+        if algorithm == 'auto':
+            algorithm = 'kd_tree' if self.measure == 'euclidean' and U.shape[1] <= 16 else 'brute'
+
+        if algorithm == 'kd_tree':
+            _, nearest = cKDTree(U).query(X, k=1)
+        else:
+            chunk = max(1, int(self.memory_budget * 2 ** 20) // (8 * U.shape[0]))
+            nearest = np.empty((X.shape[0],), dtype=np.int64)
+            for start in range(0, X.shape[0], chunk):
+                nearest[start:start + chunk] = np.argmin(distance.cdist(X[start:start + chunk], U, self.measure), axis=1)
+
+        return self.representative_labels_[nearest]
@@ -0,0 +1,254 @@
+import argparse
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+import RCC
+import data
+import inference
+import metrics
+
+BENCHMARKS = ['m_knn', 'run_rcc', 'compute_assignment', 'train_epoch', 'auc', 'score']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark RCC and Dual-GAN training on synthetic data.")
+    parser.add_argument('--n', nargs='?', default='1000,10000',
+                        help='Comma separated numbers of samples.')
+    parser.add_argument('--d', nargs='?', default='10',
+                        help='Comma separated numbers of features.')
+    parser.add_argument('--clusters', nargs='?', default='5',
+                        help='Comma separated numbers of clusters.')
+    parser.add_argument('--benchmarks', nargs='?', default=','.join(BENCHMARKS),
+                        help='Comma separated benchmarks among {}.'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--epochs', type=int, default=3,
+                        help='Number of timed training epochs, after one warm-up epoch.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic data.')
+    parser.add_argument('--output', nargs='?', default='bench.json',
+                        help='Output the path of the JSON results.')
+    parser.add_argument('--baseline', nargs='?', default=None,
+                        help='Input the path of baseline results to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown against the baseline reported as a regression.')
+    return parser.parse_args()
+
+
+def make_data(n, d, n_clusters, outlier_fraction=0.05, seed=0):
+    """
+    Synthetic data in [0, 1]^d as in the bundled data sets: gaussian clusters of inliers and uniform outliers.
+
+    Parameters
+    ----------
+    n (int) number of samples
+    d (int) number of features
+    n_clusters (int) number of clusters of inliers
+    outlier_fraction (float) fraction of outliers
+    seed (int) seed of the random generator
+
+    Returns
+    -------
+    x (array) data of shape (n, d)
+    y (array) 1 for the outliers, 0 for the inliers
+    clusters (array) cluster of each inlier, n_clusters for the outliers
+    """
+
+    rng = np.random.RandomState(seed)
+    n_out = max(2, int(n * outlier_fraction))
+    centers = rng.uniform(0.2, 0.8, (n_clusters, d))
+    clusters = rng.randint(n_clusters, size=n - n_out)
+
+    x = np.concatenate((np.clip(centers[clusters] + 0.05 * rng.randn(n - n_out, d), 0, 1), rng.uniform(0, 1, (n_out, d))), axis=0)
+    y = np.array([0] * (n - n_out) + [1] * n_out)
+    clusters = np.concatenate((clusters, [n_clusters] * n_out))
+
+    return x, y, clusters
+
+
+def bench_m_knn(x, y, clusters, args):
+    start = time.time()
+    RCC.RccCluster.m_knn(x, 10, measure='cosine')
+    return time.time() - start, x.shape[0]
+
+
+def bench_run_rcc(x, y, clusters, args):
+    edges = RCC.RccCluster.m_knn(x, 10, measure='cosine')
+    clusterer = RCC.RccCluster(measure='cosine', verbose=False)
+    start = time.time()
+    clusterer.run_rcc(x, edges)
+    return time.time() - start, x.shape[0]
+
+
+def bench_compute_assignment(x, y, clusters, args):
+    edges = RCC.RccCluster.m_knn(x, 10, measure='cosine')
+    clusterer = RCC.RccCluster(measure='cosine', verbose=False)
+    clusterer.run_rcc(x, edges)
+    epsilon = clusterer.threshold_curve_[0, 0] / clusterer.clustering_threshold
+    start = time.time()
+    clusterer.compute_assignment(epsilon)
+    return time.time() - start, x.shape[0]
+
+
+def _load_script():
+    """
+    Imports RCC-Dual-GAN.py, whose file name is not a valid module name.
+    """
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'RCC-Dual-GAN.py')
+    spec = importlib.util.spec_from_file_location('rcc_dual_gan', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_train_epoch(x, y, clusters, args):
+    from keras.optimizers import SGD
+    import ensemble
+    import selection
+
+    script = _load_script()
+
+    # the true clusters stand in for RCC, identified anomalies form one cluster
+    is_out = y == 1
+    data_out_x, data_unl_x = x[is_out], x[~is_out]
+    k_out, k_unl = 1, int(np.max(clusters[~is_out])) + 1
+    data_out_subsets = [data_out_x]
+    data_unl_subsets = data.subsets(*data.partition(data_unl_x, clusters[~is_out], k_unl)[:2])
+
+    data_size, latent_size = x.shape
+    batch_out_size = min(100, data_out_x.shape[0])
+    batch_unl_size = min(min(1000, data_size) - batch_out_size, data_unl_x.shape[0])
+    mul = math.ceil(batch_unl_size / batch_out_size)
+    out_batch_sizes = [math.ceil((subset.shape[0] * batch_out_size) / data_out_x.shape[0]) for subset in data_out_subsets]
+    unl_batch_sizes = [math.ceil((subset.shape[0] * batch_unl_size) / data_unl_x.shape[0]) for subset in data_unl_subsets]
+    out_all_sizes = [int(mul * size) for size in out_batch_sizes]
+    unl_all_sizes = [math.ceil(batch_unl_size / k_unl)] * k_unl
+    sampler_out = data.MiniBatchSampler(data_out_subsets, out_batch_sizes, noise_shapes=[(max(out_batch_sizes), k_out, latent_size), (max(out_all_sizes), k_out, latent_size)])
+    sampler_unl = data.MiniBatchSampler(data_unl_subsets, unl_batch_sizes, noise_shapes=[(max(unl_batch_sizes), k_unl, latent_size), (max(unl_all_sizes), k_unl, latent_size)])
+    prefetcher = data.Prefetcher(lambda: (sampler_out.sample(), sampler_unl.sample()))
+
+    # create_discriminator reads the dimension of the data from a global of the script
+    script.latent_size = latent_size
+    discriminator_all = script.create_discriminator(min(data_size, 1000))
+    discriminator_all.compile(optimizer=SGD(lr=0.01, decay=1e-6, momentum=0.9), loss='binary_crossentropy', metrics=['accuracy'])
+    gans_out = ensemble.BucketedSubGANs(k_out, latent_size, min(data_size, 1000), 0.01, 0.0001, 1e-6, 0.9, batch_sizes=out_batch_sizes)
+    gans_unl = ensemble.BucketedSubGANs(k_unl, latent_size, min(data_size, 1000), 0.01, 0.0001, 1e-6, 0.9, batch_sizes=unl_batch_sizes)
+    selector = selection.ModelSelector(discriminator_all, np.concatenate((data_out_x, data_unl_x), axis=0), np.array([1] * data_out_x.shape[0] + [0] * data_unl_x.shape[0]), path=os.devnull)
+
+    def epoch(index):
+        (out_batches, (noise_out, noise_out_all)), (unl_batches, (noise_unl, noise_unl_all)) = prefetcher.next()
+        gans_out.train_step(out_batches, np.ones((k_out,), dtype=bool), np.ones((k_out,), dtype=bool), 0.5, noise=noise_out)
+        gans_unl.train_step(unl_batches, np.ones((k_unl,), dtype=bool), np.ones((k_unl,), dtype=bool), 0.5, noise=noise_unl)
+        data_unl_batch = np.concatenate(unl_batches, axis=0)
+        x_all = np.concatenate([data_unl_batch] + gans_unl.generate(unl_all_sizes, noise=noise_unl_all) + out_batches + gans_out.generate(out_all_sizes, noise=noise_out_all), axis=0)
+        y_all = np.array([1] * data_unl_batch.shape[0] + [0] * (x_all.shape[0] - data_unl_batch.shape[0]))
+        discriminator_all.train_on_batch(x_all, y_all)
+        selector.update(index)
+
+    # the first epoch builds the training functions
+    epoch(0)
+    start = time.time()
+    for index in range(1, args.epochs + 1):
+        epoch(index)
+    return (time.time() - start) / args.epochs, x.shape[0]
+
+
+def bench_auc(x, y, clusters, args):
+    scores = np.random.RandomState(args.seed).uniform(0, 1, (x.shape[0], 1))
+    start = time.time()
+    metrics.auc_score(scores, y)
+    return time.time() - start, x.shape[0]
+
+
+def bench_score(x, y, clusters, args):
+    rng = np.random.RandomState(args.seed)
+    size = min(x.shape[0], 1000)
+    model = inference.NumpyDiscriminator([rng.randn(x.shape[1], size), rng.randn(size, 10), rng.randn(10, 1)],
+                                         [np.zeros((size,)), np.zeros((10,)), np.zeros((1,))])
+    start = time.time()
+    model.predict(x)
+    return time.time() - start, x.shape[0]
+
+
+def _run(name, n, d, n_clusters, args):
+    """
+    Runs one benchmark, in a fresh process so that its peak memory is its own.
+    """
+
+    x, y, clusters = make_data(n, d, n_clusters, seed=args.seed)
+    seconds, rows = globals()['bench_' + name](x, y, clusters, args)
+    return {'name': name, 'n': n, 'd': d, 'clusters': n_clusters, 'seconds': seconds,
+            'throughput': rows / seconds if seconds > 0 else float('inf'),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+def _key(result):
+    return '{name} n={n} d={d} clusters={clusters}'.format(**result)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the wall times with a baseline and returns the keys of the benchmarks slower by more than tolerance.
+
+    Parameters
+    ----------
+    results (list) benchmark results
+    baseline (list) baseline results, matched on benchmark name and data shape
+    tolerance (float) relative slowdown reported as a regression
+    """
+
+    reference = dict((_key(result), result) for result in baseline)
+    regressions = []
+    for result in results:
+        base = reference.get(_key(result))
+        if base is None:
+            continue
+        result['baseline_seconds'] = base['seconds']
+        result['ratio'] = result['seconds'] / base['seconds'] if base['seconds'] > 0 else float('inf')
+        if result['ratio'] > 1 + tolerance:
+            regressions.append(_key(result))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in args.benchmarks.split(','):
+        for n in [int(v) for v in args.n.split(',')]:
+            for d in [int(v) for v in args.d.split(',')]:
+                for n_clusters in [int(v) for v in args.clusters.split(',')]:
+                    pool = context.Pool(1)
+                    try:
+                        result = pool.apply(_run, (name, n, d, n_clusters, args))
+                    finally:
+                        pool.terminate()
+                    print('{:<50} {:>10.4f} s {:>12.1f} rows/s {:>9.1f} MB'.format(
+                        _key(result), result['seconds'], result['throughput'], result['peak_rss_mb']))
+                    results.append(result)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for result in results:
+            if 'ratio' in result:
+                print('{:<50} {:>6.2f}x baseline'.format(_key(result), result['ratio']))
+        for key in regressions:
+            print('regression: {}'.format(key))
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'cpus': multiprocessing.cpu_count(),
+                   'results': results, 'regressions': regressions}, f, indent=2)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def canonical_order(X):
+    """
+    Returns the permutation sorting the rows of X lexicographically, which does not depend on the order of the rows:
+    X[order] is the same matrix for any shuffle of X, up to the order of duplicated rows.
+
+    Parameters
+    ----------
+    X (array) 2d numpy array
+    """
+
+    return np.lexsort(X.T[::-1]) if X.shape[1] > 0 else np.arange(X.shape[0])
+
+
+class RccCache:
+    """
+    On-disk cache of RCC results, content-addressed by the data and the parameters that change the result, the
+    eigenvalue estimator and the solver settings included. The key hashes the rows in canonical order, so a shuffled
+    copy of the same data hits the cache, and the stored results are in canonical order too and mapped back to the
+    order of the rows on a hit. Every entry is one .npz file written
+    atomically; the least recently used ones are removed once the directory outgrows max_megabytes.
+
+    Parameters
+    ----------
+    directory (string) cache directory, created if missing
+    max_megabytes (float) size of the cache
+    """
+
+    PARAMS = ('k', 'measure', 'clustering_threshold', 'eps', 'max_components', 'eig_method', 'solver', 'tol',
+              'preconditioner', 'cg_max_iter')
+
+    def __init__(self, directory, max_megabytes=1024):
+
+        self.directory = directory
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, X, clusterer, order=None):
+        """
+        Hash of the rows of X in canonical order and of the parameters of the clusterer.
+
+        Parameters
+        ----------
+        X (array) data to cluster
+        clusterer (RccCluster) clusterer, the attributes listed in PARAMS are hashed
+        order (array) canonical order of the rows of X, computed if None
+        """
+
+        if order is None:
+            order = canonical_order(X)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([str(X.dtype), X.shape] + [getattr(clusterer, name) for name in self.PARAMS]).encode())
+        digest.update(np.ascontiguousarray(X[order]).data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key, order):
+        """
+        Reads an entry and maps it to the order of the rows.
+
+        Parameters
+        ----------
+        key (string) key of the entry
+        order (array) canonical order of the rows
+
+        Returns
+        -------
+        result (dict) labels, num_components, U, i and j, None if there is no entry
+        """
+
+        path = self._path(key)
+        try:
+            with np.load(path) as arrays:
+                entry = dict((name, arrays[name]) for name in arrays.files)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # mark the entry as recently used
+        os.utime(path, None)
+
+        labels = np.empty_like(entry['labels'])
+        labels[order] = entry['labels']
+        U = np.empty_like(entry['U'])
+        U[order] = entry['U']
+        return {'labels': labels, 'num_components': int(entry['num_components']), 'U': U,
+                'i': order[entry['i']], 'j': order[entry['j']]}
+
+    def store(self, key, order, labels, num_components, U, i, j):
+        """
+        Writes an entry in canonical order, then evicts the least recently used entries if the cache is full.
+
+        Parameters
+        ----------
+        key (string) key of the entry
+        order (array) canonical order of the rows
+        labels (array) cluster of each row
+        num_components (int) number of clusters
+        U (array) representatives of the rows
+        i (array) first end of the mutual kNN edges
+        j (array) second end of the mutual kNN edges
+        """
+
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0])
+
+        handle, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, labels=labels[order], num_components=num_components, U=U[order], i=rank[i], j=rank[j])
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in max_megabytes.
+
+        Parameters
+        ----------
+        keep (string) key of an entry never removed, e.g. the one just written
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz') and name != '{}.npz'.format(keep):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
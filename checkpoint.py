@@ -0,0 +1,112 @@
+import os
+import pickle
+import queue
+import tempfile
+import threading
+
+
+def restore_model(model, weights, optimizer_weights, x, y, sample_weight):
+    """
+    Loads the weights of a compiled model and of its optimizer. Keras creates the optimizer variables on the first
+    training step, so a step with zero sample weights builds them first if needed; its effect is overwritten.
+
+    Parameters
+    ----------
+    model (Model) compiled model
+    weights (list) weights of the model, as returned by get_weights
+    optimizer_weights (list) weights of its optimizer, as returned by optimizer.get_weights
+    x (array) any input batch of the model
+    y (array) any target batch of the model
+    sample_weight (array) zero sample weights of the batch
+    """
+
+    if len(model.optimizer.get_weights()) != len(optimizer_weights):
+        model.train_on_batch(x, y, sample_weight=sample_weight)
+    model.set_weights(weights)
+    if optimizer_weights:
+        model.optimizer.set_weights(optimizer_weights)
+
+
+def load(path):
+    """
+    Reads a training state written by CheckpointWriter.
+
+    Parameters
+    ----------
+    path (string) checkpoint file
+    """
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class CheckpointWriter:
+    """
+    Writes training states from a background thread, so that training goes on while the file is written. Every state
+    is pickled to a temporary file which then replaces path, so path always holds a complete state. A state submitted
+    while the previous one is still being written waits for it; an error of the thread is raised by the next call.
+
+    Parameters
+    ----------
+    path (string) checkpoint file
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            state = self._queue.get()
+            try:
+                if state is None:
+                    break
+                self._write(state)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, tmp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, state):
+        """
+        Queues a state for writing. The state must not be modified afterwards, pass copies of the arrays.
+
+        Parameters
+        ----------
+        state (dict) picklable training state
+        """
+
+        self._raise()
+        self._queue.put(state)
+
+    def close(self):
+        """
+        Waits for the pending write and stops the thread.
+        """
+
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
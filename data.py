@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+def _convert_table(path, cache_dir, source, chunk_size):
+    """
+    Parses a space separated file chunk by chunk into float32 features, ids and labels stored as .npy files in
+    cache_dir. Every file is written under a temporary name and renamed, and meta.json, written last, marks the cache
+    as complete.
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    with open(path) as f:
+        n_rows = sum(1 for line in f if line.strip())
+
+    def temporary():
+        handle, name = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        os.close(handle)
+        return name
+
+    x_tmp = temporary()
+    x = None
+    ids, labels = [], []
+    start = 0
+    for chunk in pd.read_csv(path, sep=' ', header=None, chunksize=chunk_size):
+        ids.append(chunk.pop(0).values)
+        if source['labeled']:
+            labels.append(chunk.pop(1).values)
+        if x is None:
+            x = np.lib.format.open_memmap(x_tmp, mode='w+', dtype=np.float32, shape=(n_rows, chunk.shape[1]))
+        x[start:start + chunk.shape[0]] = chunk.values
+        start += chunk.shape[0]
+    x.flush()
+    del x
+
+    arrays = {'x.npy': x_tmp}
+    for name, values in (('id.npy', ids), ('y.npy', labels)):
+        arrays[name] = temporary()
+        with open(arrays[name], 'wb') as f:
+            np.save(f, np.concatenate(values) if values else np.zeros((0,)))
+    for name, tmp in arrays.items():
+        os.replace(tmp, os.path.join(cache_dir, name))
+
+    meta_tmp = temporary()
+    with open(meta_tmp, 'w') as f:
+        json.dump(source, f)
+    os.replace(meta_tmp, os.path.join(cache_dir, 'meta.json'))
+
+
+def load_table(path, labeled=True, cache_dir=None, chunk_size=100000):
+    """
+    Loads a space separated file of rows "id [label] features". The file is parsed once into a binary cache of .npy
+    files, refreshed when the file changes, and the features are memory-mapped from it, so that loading costs neither
+    text parsing nor a copy of the data. Shuffle the rows by indexing with a permutation, see partition.
+
+    Parameters
+    ----------
+    path (string) space separated file
+    labeled (bool) whether the second column holds a label
+    cache_dir (string) directory holding the caches of the files, the cache is path + '.cache' if None
+    chunk_size (int) number of rows parsed at once when the cache is built
+
+    Returns
+    -------
+    x (array) read-only float32 features of shape (n_samples, n_features), mapped from the cache
+    ids (array) id of each row
+    y (array) label of each row, empty if not labeled
+    """
+
+    if cache_dir is None:
+        cache_dir = path + '.cache'
+    else:
+        cache_dir = os.path.join(cache_dir, hashlib.sha1(os.path.abspath(path).encode()).hexdigest())
+
+    stat = os.stat(path)
+    source = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'labeled': bool(labeled)}
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            fresh = json.load(f) == source
+    except (IOError, OSError, ValueError):
+        fresh = False
+    if not fresh:
+        _convert_table(path, cache_dir, source, chunk_size)
+
+    x = np.load(os.path.join(cache_dir, 'x.npy'), mmap_mode='r')
+    ids = np.load(os.path.join(cache_dir, 'id.npy'))
+    y = np.load(os.path.join(cache_dir, 'y.npy'))
+
+    return np.asarray(x), ids, y
+
+
+def partition(X, labels, n_clusters, out=None, rows=None):
+    """
+    Groups the rows of X by cluster with one stable sort of the labels, so that every cluster occupies a contiguous
+    block of rows. The order of the rows within a cluster is kept, or is the order of rows if given, which shuffles
+    the rows in the same gather.
+
+    Parameters
+    ----------
+    X (array) 2d array of data of shape (n_samples, n_features)
+    labels (array) cluster of each row, integers in [0, n_clusters)
+    n_clusters (int) number of clusters
+    out (array) optional array of the same shape as X receiving the sorted rows, e.g. a block of a larger array
+    rows (array) optional permutation of the rows of X, applied before the sort
+
+    Returns
+    -------
+    X_sorted (array) rows of X ordered by cluster, X_sorted = X[order]
+    offsets (array) cluster c occupies rows offsets[c]:offsets[c + 1] of X_sorted
+    order (array) permutation of the rows
+    """
+
+    labels = np.asarray(labels).ravel()
+    if rows is None:
+        order = np.argsort(labels, kind='mergesort')
+    else:
+        order = rows[np.argsort(labels[rows], kind='mergesort')]
+    offsets = np.zeros((n_clusters + 1,), dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_clusters), out=offsets[1:])
+
+    X_sorted = np.take(X, order, axis=0, out=out)
+
+    return X_sorted, offsets, order
+
+
+def subsets(X_sorted, offsets):
+    """
+    Returns the rows of every cluster as views of X_sorted, without copying.
+
+    Parameters
+    ----------
+    X_sorted (array) rows ordered by cluster, as returned by partition
+    offsets (array) cluster offsets, as returned by partition
+    """
+
+    return [X_sorted[offsets[c]:offsets[c + 1]] for c in range(offsets.shape[0] - 1)]
+
+
+class MiniBatchSampler:
+    """
+    Draws the mini-batches of every cluster subset. Each cluster keeps a preallocated random permutation of its rows and
+    a batch is the next window of row indices in it; the permutation is reshuffled in place once it is used up, so the
+    rows of a batch are distinct. The rows are gathered into reusable buffers and the noise of the sub-generators is
+    drawn along with them.
+
+    Parameters
+    ----------
+    subsets (list) rows of each cluster, 2d numpy arrays of shape (n_samples, n_features)
+    batch_sizes (list) mini-batch size of each cluster, at most its number of rows
+    noise_shapes (list) shapes of the uniform noise arrays drawn with every sample
+    n_buffers (int) number of buffers used in turn. The batches of a sample are overwritten n_buffers samples later, so
+        with a Prefetcher it must be at least its depth plus two
+    seed (int) seed of the random generator
+    """
+
+    def __init__(self, subsets, batch_sizes, noise_shapes=(), n_buffers=3, seed=None):
+
+        self.subsets = subsets
+        self.batch_sizes = [int(size) for size in batch_sizes]
+        self.noise_shapes = [tuple(shape) for shape in noise_shapes]
+        self.rng = np.random.RandomState(seed)
+
+        self._permutations = [self.rng.permutation(subset.shape[0]) for subset in subsets]
+        self._positions = [0] * len(subsets)
+
+        offsets = np.concatenate([[0], np.cumsum(self.batch_sizes)])
+        n_features = subsets[0].shape[1]
+        self._buffers = []
+        for _ in range(n_buffers):
+            buffer = np.empty((offsets[-1], n_features), dtype=subsets[0].dtype)
+            self._buffers.append([buffer[offsets[c]:offsets[c + 1]] for c in range(len(subsets))])
+        self._turn = 0
+
+    def sample(self):
+        """
+        Returns
+        -------
+        batches (list) mini-batch of each cluster, views of the current buffer
+        noise (list) uniform noise arrays in [0, 1) with the shapes noise_shapes
+        """
+
+        batches = self._buffers[self._turn]
+        self._turn = (self._turn + 1) % len(self._buffers)
+
+        for c, subset in enumerate(self.subsets):
+            size = self.batch_sizes[c]
+            if self._positions[c] + size > subset.shape[0]:
+                self.rng.shuffle(self._permutations[c])
+                self._positions[c] = 0
+            rows = self._permutations[c][self._positions[c]:self._positions[c] + size]
+            self._positions[c] += size
+            np.take(subset, rows, axis=0, out=batches[c])
+
+        noise = [self.rng.uniform(0, 1, shape) for shape in self.noise_shapes]
+
+        return batches, noise
+
+    def get_state(self):
+        """
+        Returns copies of the random state, the permutations and the positions, from which sampling can resume.
+        """
+
+        return {'rng': self.rng.get_state(), 'permutations': [permutation.copy() for permutation in self._permutations],
+                'positions': list(self._positions)}
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state.
+
+        Parameters
+        ----------
+        state (dict) state of a sampler of the same subsets
+        """
+
+        self.rng.set_state(state['rng'])
+        self._permutations = [permutation.copy() for permutation in state['permutations']]
+        self._positions = list(state['positions'])
+
+
+class Prefetcher:
+    """
+    Calls produce() in a background thread and keeps up to depth results ready, so that e.g. the mini-batches of the
+    next epoch are sampled while the current one trains.
+
+    Parameters
+    ----------
+    produce (callable) function called repeatedly without arguments
+    depth (int) number of results computed in advance
+    """
+
+    def __init__(self, produce, depth=1):
+
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._run, args=(produce,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, produce):
+        try:
+            while True:
+                self._queue.put((produce(), None))
+        except Exception as error:
+            self._queue.put((None, error))
+
+    def next(self):
+        """
+        Returns the oldest result, waiting for it if needed. An exception raised by produce() is raised here.
+        """
+
+        result, error = self._queue.get()
+        if error is not None:
+            raise error
+        return result
@@ -0,0 +1,525 @@
+from keras.layers import Dense, Input, Layer
+from keras.models import Model
+from keras.optimizers import SGD
+from keras import activations, initializers
+from keras import backend as K
+import keras
+import copy
+import numpy as np
+import time
+import checkpoint
+import nash
+
+# Keras before 2.3 divides the weighted loss by the number of non-zero sample weights, later versions by the number of
+# entries
+_MEAN_OVER_NONZERO = tuple(int(v) for v in keras.__version__.split('.')[:2]) < (2, 3)
+
+
+class StackedDense(Layer):
+    """
+    Dense layer of n_models independent sub-models evaluated side by side. The input has shape
+    (batch, n_models, input_dim) and sub-model c only sees the slice [:, c, :], so the layer computes n_models Dense
+    layers with one batched matrix product. Each kernel slice is drawn with kernel_initializer as for a Dense layer of
+    its own.
+
+    Parameters
+    ----------
+    units (int) output dimension of each sub-model
+    n_models (int) number of sub-models
+    activation (string) activation function
+    kernel_initializer (string or Initializer) initializer of each kernel slice of shape (input_dim, units)
+    """
+
+    def __init__(self, units, n_models, activation=None, kernel_initializer='glorot_uniform', **kwargs):
+        super(StackedDense, self).__init__(**kwargs)
+        self.units = units
+        self.n_models = n_models
+        self.activation = activations.get(activation)
+        self.kernel_initializer = initializers.get(kernel_initializer)
+
+    def build(self, input_shape):
+        input_dim = input_shape[-1]
+
+        def stacked_initializer(shape, dtype=None):
+            return K.cast(K.stack([self.kernel_initializer(shape[1:]) for _ in range(shape[0])]), dtype or K.floatx())
+
+        self.kernel = self.add_weight(shape=(self.n_models, input_dim, self.units), initializer=stacked_initializer,
+                                      name='kernel')
+        self.bias = self.add_weight(shape=(self.n_models, self.units), initializer='zeros', name='bias')
+        super(StackedDense, self).build(input_shape)
+
+    def call(self, inputs):
+        outputs = K.batch_dot(K.permute_dimensions(inputs, (1, 0, 2)), self.kernel, axes=[2, 1])
+        outputs = K.permute_dimensions(outputs, (1, 0, 2)) + self.bias
+        return self.activation(outputs)
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self.units,)
+
+    def get_config(self):
+        config = {'units': self.units,
+                  'n_models': self.n_models,
+                  'activation': activations.serialize(self.activation),
+                  'kernel_initializer': initializers.serialize(self.kernel_initializer)}
+        base_config = super(StackedDense, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# Sub-Generators
+def create_generator_ensemble(n_models, latent_size):
+    latent = Input(shape=(n_models, latent_size))
+    fake_data = StackedDense(latent_size, n_models, activation='relu', kernel_initializer=keras.initializers.Identity(gain=1.0))(latent)
+    fake_data = StackedDense(latent_size, n_models, activation='relu', kernel_initializer=keras.initializers.Identity(gain=1.0))(fake_data)
+    return Model(latent, fake_data)
+
+
+# Sub-Discriminators, the wide first layer is shared by all the clusters if shared_trunk, one head per cluster follows
+def create_sub_discriminator_ensemble(n_models, latent_size, size, shared_trunk=False):
+    data = Input(shape=(n_models, latent_size))
+    if shared_trunk:
+        fake = Dense(size, activation='relu', kernel_initializer=keras.initializers.VarianceScaling(scale=1.0, mode='fan_in', distribution='normal', seed=None))(data)
+    else:
+        fake = StackedDense(size, n_models, activation='relu', kernel_initializer=keras.initializers.VarianceScaling(scale=1.0, mode='fan_in', distribution='normal', seed=None))(data)
+    fake = StackedDense(10, n_models, activation='relu', kernel_initializer=keras.initializers.VarianceScaling(scale=1.0, mode='fan_in', distribution='normal', seed=None))(fake)
+    fake = StackedDense(1, n_models, activation='sigmoid', kernel_initializer=keras.initializers.VarianceScaling(scale=1.0, mode='fan_in', distribution='normal', seed=None))(fake)
+    return Model(data, fake)
+
+
+class SubGANEnsemble:
+    """
+    The sub-generators, sub-discriminators and combine models of one side (identified anomalies or unlabeled data),
+    fused into three Keras models whose layers hold one slice per cluster. A training step of all the sub-GANs is one
+    train_on_batch call per model instead of one per cluster.
+
+    The mini-batches of the clusters are padded to a common size. Sample weights mask the padding and rescale the loss
+    so that every cluster gets the gradient of its own mean loss, exactly as when it is trained alone. A step costs
+    n_clusters times the largest mini-batch, so clusters of very different sizes are better split over several
+    ensembles, see BucketedSubGANs.
+
+    With shared_trunk, the sub-discriminators share their first layer, of dis_size units, and keep their own small
+    heads. The parameters and momentum of that layer are held once instead of once per cluster; the heads still get
+    the gradient of their own cluster loss and the trunk gets the sum of them. The sub-generators are unchanged, so
+    stopping them works the same.
+
+    Parameters
+    ----------
+    n_clusters (int) number of sub-GANs
+    latent_size (int) dimension of the data
+    dis_size (int) width of the first layer of the sub-discriminators
+    lr_d (float) learning rate of the sub-discriminators
+    lr_g (float) learning rate of the sub-generators
+    decay (float) learning rate decay
+    momentum (float) momentum of SGD
+    shared_trunk (bool) whether the sub-discriminators share their first layer
+    """
+
+    def __init__(self, n_clusters, latent_size, dis_size, lr_d, lr_g, decay, momentum, shared_trunk=False):
+
+        self.n_clusters = n_clusters
+        self.latent_size = latent_size
+        self.shared_trunk = shared_trunk
+        self._config = (latent_size, dis_size, lr_d, lr_g, decay, momentum)
+
+        self.discriminator = create_sub_discriminator_ensemble(n_clusters, latent_size, dis_size, shared_trunk)
+        self.discriminator.compile(optimizer=SGD(lr=lr_d, decay=decay, momentum=momentum), loss='binary_crossentropy', sample_weight_mode='temporal')
+
+        self.generator = create_generator_ensemble(n_clusters, latent_size)
+        latent = Input(shape=(n_clusters, latent_size))
+        self.discriminator.trainable = False
+        fake = self.discriminator(self.generator(latent))
+        self.combine_model = Model(latent, fake)
+        self.combine_model.compile(optimizer=SGD(lr=lr_g, decay=decay, momentum=momentum), loss='binary_crossentropy', sample_weight_mode='temporal')
+
+        self.active = np.ones((n_clusters,), dtype=bool)
+
+    def _stack(self, batches, size):
+        """
+        Pads the mini-batches of the clusters into one array of shape (size, n_clusters, latent_size).
+        """
+
+        stacked = np.zeros((size, self.n_clusters, self.latent_size))
+        for c, batch in enumerate(batches):
+            stacked[:batch.shape[0], c] = batch
+        return stacked
+
+    @staticmethod
+    def _loss_weights(mask):
+        """
+        Sample weights of shape (batch, n_clusters) turning the masked mean loss computed by Keras into the sum of the
+        mean losses of the clusters.
+        """
+
+        counts = np.sum(mask, axis=0)
+        total = np.sum(mask) if _MEAN_OVER_NONZERO else mask.size
+        scale = np.where(counts > 0, total / np.maximum(counts, 1), 0.0)
+        return mask * scale[None, :]
+
+    def _freeze(self, stopped):
+        """
+        Clears the momentum of the stopped sub-generators, so that they no longer move once their loss is masked out.
+        """
+
+        for weight in getattr(self.combine_model.optimizer, 'weights', []):
+            value = K.get_value(weight)
+            if value.ndim > 0 and value.shape[0] == self.n_clusters:
+                value[stopped] = 0
+                K.set_value(weight, value)
+
+    def train_step(self, real_batches, active, evaluate, nash_thr_1, noise=None, random_state=None):
+        """
+        Trains every sub-discriminator on its real mini-batch and as many generated points, then every active
+        sub-generator through its combine model.
+
+        Parameters
+        ----------
+        real_batches (list) real mini-batch of each cluster, 2d numpy arrays of shape (n_samples, latent_size)
+        active (array) boolean mask of the sub-generators to train
+        evaluate (array) boolean mask of the sub-GANs whose Nash equilibrium is evaluated
+        nash_thr_1 (float) threshold 1 of the Nash equilibrium evaluation
+        noise (array) optional noise of the sub-generators, of shape (max batch size, n_clusters, latent_size)
+        random_state (int) seed of the points drawn by the Nash equilibrium evaluation, numpy's global generator if None
+
+        Returns
+        -------
+        ratios (array) Nash ratio of the evaluated sub-GANs, nan for the others
+        losses (array) sum over the clusters of the sub-discriminator and sub-generator losses, the latter nan if no
+        sub-generator is active
+        """
+
+        active = np.asarray(active, dtype=bool)
+        stopped = self.active & ~active
+        if np.any(stopped):
+            self._freeze(stopped)
+        self.active = active.copy()
+
+        counts = np.array([batch.shape[0] for batch in real_batches])
+        size = np.max(counts)
+        mask = np.arange(size)[:, None] < counts[None, :]
+
+        # Train sub-discriminators
+        if noise is None:
+            noise = np.random.uniform(0, 1, (size, self.n_clusters, self.latent_size))
+        generated = self.generator.predict(noise, batch_size=size, verbose=0)
+        x = np.concatenate((self._stack(real_batches, size), generated), axis=0)
+        y = np.concatenate((np.ones((size, self.n_clusters, 1)), np.zeros((size, self.n_clusters, 1))), axis=0)
+        losses = np.full((2,), np.nan)
+        losses[0] = self.discriminator.train_on_batch(x, y, sample_weight=self._loss_weights(np.concatenate((mask, mask), axis=0)))
+
+        # Train sub-generators
+        if np.any(active):
+            trick = np.ones((size, self.n_clusters, 1))
+            losses[1] = self.combine_model.train_on_batch(noise, trick, sample_weight=self._loss_weights(mask & active[None, :]))
+
+        # The evaluation of Nash equilibrium
+        ratios = np.full((self.n_clusters,), np.nan)
+        evaluate = np.flatnonzero(evaluate)
+        if evaluate.shape[0] > 0:
+            ratios[evaluate] = nash.nash_ratios([real_batches[c] for c in evaluate],
+                                                [generated[:counts[c], c] for c in evaluate], nash_thr_1,
+                                                random_state=None if random_state is None else np.random.RandomState(random_state))
+
+        return ratios, losses
+
+    def get_state(self):
+        """
+        Returns copies of the weights of the models and optimizers and of the mask of the active sub-generators.
+        """
+
+        return {'discriminator': self.discriminator.get_weights(),
+                'discriminator_optimizer': self.discriminator.optimizer.get_weights(),
+                'generator': self.generator.get_weights(),
+                'combine_optimizer': self.combine_model.optimizer.get_weights(),
+                'active': self.active.copy()}
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state.
+
+        Parameters
+        ----------
+        state (dict) state of an ensemble of the same shape
+        """
+
+        x = np.zeros((1, self.n_clusters, self.latent_size))
+        y = np.zeros((1, self.n_clusters, 1))
+        zero = np.zeros((1, self.n_clusters))
+        checkpoint.restore_model(self.discriminator, state['discriminator'], state['discriminator_optimizer'], x, y, zero)
+
+        # the combine model also holds the weights of the sub-discriminators, which are restored again afterwards
+        checkpoint.restore_model(self.combine_model, self.combine_model.get_weights(), state['combine_optimizer'], x, y, zero)
+        self.generator.set_weights(state['generator'])
+        self.discriminator.set_weights(state['discriminator'])
+        self.active = np.asarray(state['active'], dtype=bool).copy()
+
+    def generator_weights(self, c):
+        """
+        Returns copies of the kernels and biases of sub-generator c, in the order of the layers.
+        """
+
+        return [weight[c].copy() for weight in self.generator.get_weights()]
+
+    def subset(self, clusters):
+        """
+        Returns a new SubGANEnsemble of some of the clusters, with their weights and optimizer states. The weights of
+        the StackedDense layers and their momentum are sliced, the shared trunk and the iteration counts are copied.
+
+        Parameters
+        ----------
+        clusters (array) indices of the clusters to keep
+        """
+
+        clusters = np.asarray(clusters, dtype=np.int64)
+        n_shared = 2 if self.shared_trunk else 0
+
+        def take(arrays, n_shared):
+            return [array.copy() if index < n_shared else array[clusters] for index, array in enumerate(arrays)]
+
+        def take_optimizer(arrays, n_shared):
+            # the optimizer holds its iteration count, then one slot per trainable weight, in the order of the weights
+            return arrays[:1] + take(arrays[1:], n_shared) if arrays else []
+
+        state = self.get_state()
+        gans = SubGANEnsemble(clusters.shape[0], *self._config, shared_trunk=self.shared_trunk)
+        gans.set_state({'discriminator': take(state['discriminator'], n_shared),
+                        'discriminator_optimizer': take_optimizer(state['discriminator_optimizer'], n_shared),
+                        'generator': take(state['generator'], 0),
+                        'combine_optimizer': take_optimizer(state['combine_optimizer'], 0),
+                        'active': state['active'][clusters]})
+        return gans
+
+    def generate(self, counts, noise=None):
+        """
+        Generates counts[c] points with sub-generator c.
+
+        Parameters
+        ----------
+        counts (list) number of points to generate for each cluster
+        noise (array) optional noise of the sub-generators, of shape (max(counts), n_clusters, latent_size)
+
+        Returns
+        -------
+        generated (list) generated points of each cluster, 2d numpy arrays of shape (counts[c], latent_size)
+        """
+
+        size = max(counts)
+        if noise is None:
+            noise = np.random.uniform(0, 1, (size, self.n_clusters, self.latent_size))
+        generated = self.generator.predict(noise, batch_size=size, verbose=0)
+        return [generated[:count, c] for c, count in enumerate(counts)]
+
+
+# Cost of one fused step in padded rows times the width of the sub-discriminators, measured on a CPU: a step costs about
+# as much as 4000 to 5000 padded rows of 1000 wide sub-discriminators, whatever the dimension of the data
+_STEP_OVERHEAD = 5e6
+
+
+def bucket_clusters(batch_sizes, max_buckets=4, overhead_rows=5000):
+    """
+    Splits the clusters into at most max_buckets buckets of similar mini-batch sizes, each bucket being padded to its
+    largest mini-batch. The buckets minimize the number of padded rows plus overhead_rows per bucket, the fixed cost of
+    one more fused step, by dynamic programming over the clusters sorted by size.
+
+    Parameters
+    ----------
+    batch_sizes (list) mini-batch size of each cluster
+    max_buckets (int) maximum number of buckets
+    overhead_rows (int) cost of one fused step, in padded rows
+
+    Returns
+    -------
+    buckets (list) clusters of each bucket, in increasing order
+    """
+
+    order = np.argsort(-np.asarray(batch_sizes), kind='mergesort')
+    sizes = np.asarray(batch_sizes)[order]
+    n = sizes.shape[0]
+    max_buckets = max(1, min(max_buckets, n))
+
+    # cost[b, j] is the best cost of the j largest clusters in b + 1 buckets, start[b, j] the first cluster of the last
+    cost = np.full((max_buckets, n + 1), np.inf)
+    start = np.zeros((max_buckets, n + 1), dtype=int)
+    for j in range(1, n + 1):
+        cost[0, j] = j * sizes[0] + overhead_rows
+    for b in range(1, max_buckets):
+        for j in range(b + 1, n + 1):
+            candidates = [cost[b - 1, i] + (j - i) * sizes[i] + overhead_rows for i in range(b, j)]
+            best = int(np.argmin(candidates))
+            cost[b, j], start[b, j] = candidates[best], best + b
+
+    buckets = []
+    b, j = int(np.argmin(cost[:, n])), n
+    while j > 0:
+        i = start[b, j] if b > 0 else 0
+        buckets.append(sorted(int(c) for c in order[i:j]))
+        b, j = b - 1, i
+    return buckets[::-1]
+
+
+class BucketedSubGANs:
+    """
+    The sub-GANs of one side split into a few SubGANEnsembles of clusters with similar mini-batch sizes, with the
+    interface of SubGANEnsemble. A fused step pads every cluster to the largest mini-batch, so a skewed RCC partition,
+    e.g. one cluster of 800 rows and many of 5, would cost n_clusters times 800 rows; the buckets, chosen by
+    bucket_clusters, bring the cost close to the real number of rows for a few more steps. With shared_trunk, the
+    sub-discriminators share one layer and the clusters stay in one ensemble.
+
+    Parameters
+    ----------
+    n_clusters (int) number of sub-GANs
+    latent_size (int) dimension of the data
+    dis_size (int) width of the first layer of the sub-discriminators
+    lr_d (float) learning rate of the sub-discriminators
+    lr_g (float) learning rate of the sub-generators
+    decay (float) learning rate decay
+    momentum (float) momentum of SGD
+    shared_trunk (bool) whether the sub-discriminators share their first layer
+    batch_sizes (list) expected mini-batch size of each cluster, one bucket if None
+    max_buckets (int) maximum number of ensembles
+    overhead_rows (int) cost of one more fused step, in padded rows, estimated from dis_size if None
+    """
+
+    def __init__(self, n_clusters, latent_size, dis_size, lr_d, lr_g, decay, momentum, shared_trunk=False,
+                 batch_sizes=None, max_buckets=4, overhead_rows=None):
+
+        self.n_clusters = n_clusters
+        self.latent_size = latent_size
+        self.shared_trunk = shared_trunk
+
+        if batch_sizes is None or shared_trunk:
+            self.buckets = [list(range(n_clusters))]
+        else:
+            if overhead_rows is None:
+                overhead_rows = int(_STEP_OVERHEAD / dis_size)
+            self.buckets = bucket_clusters(batch_sizes, max_buckets, overhead_rows)
+        self.ensembles = [SubGANEnsemble(len(bucket), latent_size, dis_size, lr_d, lr_g, decay, momentum,
+                                         shared_trunk=shared_trunk) for bucket in self.buckets]
+
+    def _locate(self, c):
+        for bucket, gans in zip(self.buckets, self.ensembles):
+            if c in bucket:
+                return gans, bucket.index(c)
+        raise IndexError('no cluster {}'.format(c))
+
+    def train_step(self, real_batches, active, evaluate, nash_thr_1, noise=None, random_state=None):
+        """
+        See SubGANEnsemble.train_step, every bucket gets its slice of the noise and its own seed drawn from
+        random_state.
+        """
+
+        active = np.asarray(active, dtype=bool)
+        evaluate = np.asarray(evaluate, dtype=bool)
+        seeds = [None] * len(self.buckets)
+        if random_state is not None:
+            seeds = [int(seed) for seed in np.random.RandomState(random_state).randint(2 ** 31 - 1, size=len(self.buckets))]
+
+        ratios = np.full((self.n_clusters,), np.nan)
+        bucket_losses = []
+        for bucket, gans, seed in zip(self.buckets, self.ensembles, seeds):
+            batches = [real_batches[c] for c in bucket]
+            bucket_noise = None if noise is None else noise[:max(batch.shape[0] for batch in batches), bucket]
+            bucket_ratios, losses = gans.train_step(batches, active[bucket], evaluate[bucket], nash_thr_1,
+                                                    noise=bucket_noise, random_state=seed)
+            ratios[bucket] = bucket_ratios
+            bucket_losses.append(losses)
+
+        # the losses are sums over the clusters, nan only if nan in every bucket
+        bucket_losses = np.array(bucket_losses)
+        losses = np.where(np.all(np.isnan(bucket_losses), axis=0), np.nan, np.nansum(bucket_losses, axis=0))
+
+        return ratios, losses
+
+    def generate(self, counts, noise=None):
+        """
+        See SubGANEnsemble.generate, every bucket gets its slice of the noise.
+        """
+
+        generated = [None] * self.n_clusters
+        for bucket, gans in zip(self.buckets, self.ensembles):
+            bucket_counts = [counts[c] for c in bucket]
+            bucket_noise = None if noise is None else noise[:max(bucket_counts), bucket]
+            for c, points in zip(bucket, gans.generate(bucket_counts, noise=bucket_noise)):
+                generated[c] = points
+
+        return generated
+
+    def generator_weights(self, c):
+        """
+        See SubGANEnsemble.generator_weights.
+        """
+
+        gans, index = self._locate(c)
+        return gans.generator_weights(index)
+
+    def get_state(self):
+        """
+        Returns the buckets and the state of every ensemble, see SubGANEnsemble.get_state.
+        """
+
+        return {'buckets': [list(bucket) for bucket in self.buckets],
+                'ensembles': [gans.get_state() for gans in self.ensembles]}
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state, the buckets must be the same.
+
+        Parameters
+        ----------
+        state (dict) state of sub-GANs of the same shape
+        """
+
+        if [list(bucket) for bucket in state['buckets']] != [list(bucket) for bucket in self.buckets]:
+            raise ValueError('the state has buckets {}, not {}'.format(state['buckets'], self.buckets))
+        for gans, gans_state in zip(self.ensembles, state['ensembles']):
+            gans.set_state(gans_state)
+
+    def subset(self, clusters):
+        """
+        Returns new BucketedSubGANs of some of the clusters, numbered in the order of clusters. The buckets keep their
+        remaining clusters, see SubGANEnsemble.subset, and the empty ones are dropped.
+
+        Parameters
+        ----------
+        clusters (array) indices of the clusters to keep
+        """
+
+        position = dict((int(c), index) for index, c in enumerate(clusters))
+        gans = copy.copy(self)
+        gans.n_clusters = len(position)
+        gans.buckets, gans.ensembles = [], []
+        for bucket, bucket_gans in zip(self.buckets, self.ensembles):
+            kept = [index for index, c in enumerate(bucket) if c in position]
+            if kept:
+                gans.buckets.append([position[bucket[index]] for index in kept])
+                gans.ensembles.append(bucket_gans.subset(kept))
+        return gans
+
+
+def probe_step_seconds(batch_sizes, latent_size, dis_size, shared_trunk=False, steps=3, **kwargs):
+    """
+    Measures the time of one training step and one generation of BucketedSubGANs, on random data, after a warm-up
+    step that builds the training functions. The cost of a step grows with the number of buckets and with the padded
+    rows of each bucket, its number of clusters times its largest mini-batch.
+
+    Parameters
+    ----------
+    batch_sizes (list) mini-batch size of each cluster
+    latent_size (int) dimension of the data
+    dis_size (int) width of the first layer of the sub-discriminators
+    shared_trunk (bool) whether the sub-discriminators share their first layer
+    steps (int) number of timed steps
+    kwargs (dict) max_buckets and overhead_rows of the buckets
+    """
+
+    n_clusters = len(batch_sizes)
+    gans = BucketedSubGANs(n_clusters, latent_size, dis_size, 0.01, 0.0001, 1e-6, 0.9, shared_trunk=shared_trunk,
+                           batch_sizes=batch_sizes, **kwargs)
+    batches = [np.random.uniform(0, 1, (size, latent_size)) for size in batch_sizes]
+    active = np.ones((n_clusters,), dtype=bool)
+
+    gans.train_step(batches, active, active, 0.5)
+    gans.generate(batch_sizes)
+    start = time.time()
+    for _ in range(steps):
+        gans.train_step(batches, active, active, 0.5)
+        gans.generate(batch_sizes)
+    return (time.time() - start) / steps
@@ -0,0 +1,96 @@
+import argparse
+
+import numpy as np
+
+
+def export_discriminator(model, path):
+    """
+    Writes the weights of the final discriminator (Dense relu, Dense relu, Dropout, Dense sigmoid) to a compressed
+    .npz file, in float32. Dropout has no weights and is the identity at inference time.
+
+    Parameters
+    ----------
+    model (Model) the final discriminator
+    path (string) output file
+    """
+
+    weights = model.get_weights()
+    arrays = {}
+    for layer in range(len(weights) // 2):
+        arrays['kernel_{}'.format(layer)] = weights[2 * layer].astype(np.float32)
+        arrays['bias_{}'.format(layer)] = weights[2 * layer + 1].astype(np.float32)
+    np.savez_compressed(path, **arrays)
+
+
+class NumpyDiscriminator:
+    """
+    Forward pass of an exported final discriminator in NumPy only: relu hidden layers and a sigmoid output, computed in
+    float32 batch by batch. Loading it needs no deep learning framework.
+
+    Parameters
+    ----------
+    kernels (list) kernel of each Dense layer, 2d numpy arrays of shape (input_dim, units)
+    biases (list) bias of each Dense layer
+    """
+
+    def __init__(self, kernels, biases):
+
+        self.kernels = [np.asarray(kernel, dtype=np.float32) for kernel in kernels]
+        self.biases = [np.asarray(bias, dtype=np.float32) for bias in biases]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a discriminator written by export_discriminator.
+
+        Parameters
+        ----------
+        path (string) .npz file
+        """
+
+        with np.load(path) as arrays:
+            n_layers = len([name for name in arrays.files if name.startswith('kernel_')])
+            kernels = [arrays['kernel_{}'.format(layer)] for layer in range(n_layers)]
+            biases = [arrays['bias_{}'.format(layer)] for layer in range(n_layers)]
+        return cls(kernels, biases)
+
+    def predict(self, x, batch_size=10000, verbose=0):
+        """
+        Returns the discriminator output of shape (n_samples, 1), as Model.predict.
+
+        Parameters
+        ----------
+        x (array) data of shape (n_samples, n_features)
+        batch_size (int) number of rows computed at once
+        verbose (int) unused, for compatibility with Model.predict
+        """
+
+        output = np.empty((x.shape[0], self.kernels[-1].shape[1]), dtype=np.float32)
+        for start in range(0, x.shape[0], batch_size):
+            h = np.asarray(x[start:start + batch_size], dtype=np.float32)
+            for kernel, bias in zip(self.kernels[:-1], self.biases[:-1]):
+                h = np.dot(h, kernel)
+                h += bias
+                np.maximum(h, 0, out=h)
+            h = np.dot(h, self.kernels[-1])
+            h += self.biases[-1]
+
+            # numerically stable sigmoid
+            output[start:start + batch_size] = 0.5 * (1.0 + np.tanh(0.5 * h))
+
+        return output
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a trained RCC-Dual-GAN discriminator for NumPy inference.")
+    parser.add_argument('--model', nargs='?', default='discriminator.h5',
+                        help='Input the path of the trained discriminator.')
+    parser.add_argument('--output', nargs='?', default='discriminator.npz',
+                        help='Output the path of the exported weights.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    from keras.models import load_model
+    export_discriminator(load_model(args.model), args.output)
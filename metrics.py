@@ -0,0 +1,65 @@
+import numpy as np
+
+from scipy.stats import rankdata
+
+
+def auc_score(scores, labels):
+    """
+    Area under the ROC curve of the discriminator output, computed from ranks with a single sort. It is the probability
+    that an outlier gets a lower score than an inlier, ties counting one half.
+
+    Parameters
+    ----------
+    scores (array) discriminator output, higher means more normal
+    labels (array) 1 for outliers, 0 for inliers
+    """
+
+    scores = np.ravel(scores)
+    is_outlier = np.ravel(labels) == 1
+    n_out = np.sum(is_outlier)
+    n_in = is_outlier.shape[0] - n_out
+
+    # average ranks make every tie between an outlier and an inlier count one half
+    ranks = rankdata(scores)
+    wins = np.sum(ranks[~is_outlier]) - n_in * (n_in + 1) / 2.0
+
+    return wins / (n_in * n_out)
+
+
+def eva_score(scores, labels):
+    """
+    Model selection score: the mean rank of the outliers when sorting all the scores in ascending order, divided by the
+    number of samples. Lower is better.
+
+    Parameters
+    ----------
+    scores (array) discriminator output, higher means more normal
+    labels (array) 1 for outliers, 0 for inliers
+    """
+
+    scores = np.ravel(scores)
+    is_outlier = np.ravel(labels) == 1
+
+    ranks = rankdata(scores)
+
+    return np.sum(ranks[is_outlier]) / (scores.shape[0] * np.sum(is_outlier))
+
+
+def precision_at_k(scores, labels, k):
+    """
+    Fraction of outliers among the k samples with the lowest scores.
+
+    Parameters
+    ----------
+    scores (array) discriminator output, higher means more normal
+    labels (array) 1 for outliers, 0 for inliers
+    k (int) number of samples reported as outliers
+    """
+
+    scores = np.ravel(scores)
+    labels = np.ravel(labels)
+    k = min(k, scores.shape[0])
+
+    top = np.argpartition(scores, k - 1)[:k]
+
+    return np.mean(labels[top] == 1)
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def nash_ratios(real_batches, fake_batches, nash_thr_1, sample_num=10, random_state=None):
+    """
+    Evaluates the Nash equilibrium of several sub-GANs at once. For every sub-GAN, up to sample_num generated points are
+    drawn and their max(sample_num, 2) nearest neighbours are looked up among the real and generated points of its
+    batch (the point itself included). A generated point counts when the fraction of real neighbours is at least
+    nash_thr_1, and the returned ratio is the number of counted points divided by max(sample_num, 2).
+
+    All the sub-GANs are padded to a common batch size, so the distances of every sampled point are computed in one
+    batched product and the neighbours are found by a single argpartition.
+
+    Parameters
+    ----------
+    real_batches (list) real mini-batch of each sub-GAN, 2d numpy arrays of shape (n_samples, n_features)
+    fake_batches (list) generated mini-batch of each sub-GAN, same shapes as real_batches
+    nash_thr_1 (float) minimum fraction of real neighbours for a generated point to count
+    sample_num (int) maximum number of generated points evaluated per sub-GAN
+    random_state (RandomState) random generator drawing the evaluated points, numpy's global one if None
+
+    Returns
+    -------
+    ratios (array) Nash ratio of each sub-GAN
+    """
+
+    rng = np.random if random_state is None else random_state
+
+    n_gans = len(real_batches)
+    batch = np.array([real.shape[0] for real in real_batches])
+    samples = np.minimum(sample_num, batch)
+    neighbours = np.maximum(samples, 2)
+
+    n_max = 2 * np.max(batch)
+    s_max = np.max(samples)
+    k_max = np.max(neighbours)
+    n_features = real_batches[0].shape[1]
+
+    x = np.zeros((n_gans, n_max, n_features))
+    is_real = np.zeros((n_gans, n_max), dtype=bool)
+    valid = np.zeros((n_gans, n_max), dtype=bool)
+    points = np.zeros((n_gans, s_max, n_features))
+    for c in range(n_gans):
+        n = batch[c]
+        x[c, :n] = real_batches[c]
+        x[c, n:2 * n] = fake_batches[c]
+        is_real[c, :n] = True
+        valid[c, :2 * n] = True
+        points[c, :samples[c]] = fake_batches[c][rng.permutation(n)[:samples[c]]]
+
+    # squared euclidean distances of shape (n_gans, s_max, n_max), padding is never a neighbour
+    dist = (np.sum(points ** 2, axis=2)[:, :, None] + np.sum(x ** 2, axis=2)[:, None, :]
+            - 2 * np.einsum('csd,cnd->csn', points, x))
+    dist[~np.broadcast_to(valid[:, None, :], dist.shape)] = np.inf
+
+    # the k_max nearest neighbours, sorted by distance
+    nearest = np.argpartition(dist, k_max - 1, axis=2)[:, :, :k_max]
+    gan_idx = np.arange(n_gans)[:, None, None]
+    point_idx = np.arange(s_max)[None, :, None]
+    nearest = nearest[gan_idx, point_idx, np.argsort(dist[gan_idx, point_idx, nearest], axis=2)]
+
+    # only the first max(sample_num, 2) neighbours of the sampled points of each sub-GAN take part
+    in_range = np.arange(k_max)[None, None, :] < neighbours[:, None, None]
+    real_count = np.sum(is_real[gan_idx, nearest] & in_range, axis=2)
+    counted = (real_count / neighbours[:, None] >= nash_thr_1) & (np.arange(s_max)[None, :] < samples[:, None])
+
+    return np.sum(counted, axis=1) / neighbours
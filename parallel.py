@@ -0,0 +1,230 @@
+import multiprocessing
+import traceback
+
+import numpy as np
+
+
+def _worker(conn):
+    """
+    Worker loop: holds BucketedSubGANs shards and runs the method calls it receives on them. A message is a list of
+    (shard_id, method, args) calls, answered with the list of their results.
+    """
+
+    import ensemble
+
+    shards = {}
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        try:
+            results = []
+            for shard_id, method, args in message:
+                if method == '__init__':
+                    shards[shard_id] = ensemble.BucketedSubGANs(*args)
+                    results.append(None)
+                else:
+                    results.append(getattr(shards[shard_id], method)(*args))
+            conn.send((results, None))
+        except Exception:
+            conn.send((None, traceback.format_exc()))
+
+
+def _group_noise(noise, group, size):
+    """
+    Slice of the noise of the clusters of a group, None if noise is None.
+    """
+
+    return None if noise is None else np.ascontiguousarray(noise[:size, group])
+
+
+class SubGANWorkerPool:
+    """
+    Pool of worker processes keeping sub-GAN models resident between calls. The processes are spawned, forking a
+    process that already runs a deep learning backend is unsafe.
+
+    Parameters
+    ----------
+    n_workers (int) number of worker processes
+    """
+
+    def __init__(self, n_workers):
+
+        context = multiprocessing.get_context('spawn')
+        self.n_workers = n_workers
+        self._conns = []
+        self._processes = []
+        for _ in range(n_workers):
+            parent, child = context.Pipe()
+            process = context.Process(target=_worker, args=(child,))
+            process.daemon = True
+            process.start()
+            self._conns.append(parent)
+            self._processes.append(process)
+        self._next_shard = 0
+
+    def new_shard_id(self):
+        self._next_shard += 1
+        return self._next_shard
+
+    def call(self, messages):
+        """
+        Sends one message to each worker that has calls to run, then waits for all the answers, so the workers run in
+        parallel.
+
+        Parameters
+        ----------
+        messages (dict) worker index -> list of (shard_id, method, args) calls
+
+        Returns
+        -------
+        results (dict) worker index -> list of the results of the calls
+        """
+
+        for worker, message in messages.items():
+            self._conns[worker].send(message)
+
+        results = {}
+        errors = []
+        for worker in messages:
+            result, error = self._conns[worker].recv()
+            if error is not None:
+                errors.append(error)
+            results[worker] = result
+        if errors:
+            raise RuntimeError('sub-GAN worker failed:\n{}'.format(errors[0]))
+
+        return results
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None)
+        for process in self._processes:
+            process.join()
+
+
+def balanced_groups(sizes, n_groups):
+    """
+    Splits the clusters into at most n_groups groups of similar total size, largest cluster first into the lightest
+    group.
+
+    Parameters
+    ----------
+    sizes (list) size of each cluster
+    n_groups (int) number of groups
+    """
+
+    groups = [[] for _ in range(min(n_groups, len(sizes)))]
+    loads = np.zeros((len(groups),))
+    for c in np.argsort(sizes, kind='mergesort')[::-1]:
+        lightest = int(np.argmin(loads))
+        groups[lightest].append(int(c))
+        loads[lightest] += sizes[c]
+
+    return [sorted(group) for group in groups]
+
+
+class ParallelSubGANs:
+    """
+    The sub-GANs of one side spread over the processes of a SubGANWorkerPool, with the interface of
+    ensemble.SubGANEnsemble. The clusters are split into groups of similar size and every group is an
+    ensemble.BucketedSubGANs resident in one worker, so the sub-GAN steps of an epoch run on all the workers at once. Only the mini-batches go
+    to the workers and only the Nash ratios, the losses and the generated points come back. The noise of every group is
+    sliced from the noise drawn in the main process, and the seed of its Nash evaluation is drawn from numpy's global
+    generator of the main process, so the workers use no random state of their own.
+
+    Parameters
+    ----------
+    pool (SubGANWorkerPool) worker processes
+    n_clusters (int) number of sub-GANs
+    latent_size (int) dimension of the data
+    dis_size (int) width of the first layer of the sub-discriminators
+    lr_d (float) learning rate of the sub-discriminators
+    lr_g (float) learning rate of the sub-generators
+    decay (float) learning rate decay
+    momentum (float) momentum of SGD
+    cluster_sizes (list) number of rows of each cluster, used to balance the groups
+    shared_trunk (bool) whether the sub-discriminators of a group share their first layer
+    batch_sizes (list) expected mini-batch size of each cluster, used to bucket the clusters of a group
+    """
+
+    def __init__(self, pool, n_clusters, latent_size, dis_size, lr_d, lr_g, decay, momentum, cluster_sizes=None,
+                 shared_trunk=False, batch_sizes=None):
+
+        self.pool = pool
+        self.n_clusters = n_clusters
+        self.latent_size = latent_size
+
+        if cluster_sizes is None:
+            cluster_sizes = [1] * n_clusters
+        self.groups = balanced_groups(cluster_sizes, pool.n_workers)
+        self.shards = [pool.new_shard_id() for _ in self.groups]
+
+        self._call('__init__', lambda group: (len(group), latent_size, dis_size, lr_d, lr_g, decay, momentum, shared_trunk,
+                                              None if batch_sizes is None else [batch_sizes[c] for c in group]))
+
+    def _call(self, method, group_args):
+        """
+        Runs a method of every shard with the arguments group_args(group), one shard per worker.
+        """
+
+        messages = dict((worker, [(shard, method, group_args(group))])
+                        for worker, (shard, group) in enumerate(zip(self.shards, self.groups)))
+        results = self.pool.call(messages)
+        return [results[worker][0] for worker in range(len(self.groups))]
+
+    def train_step(self, real_batches, active, evaluate, nash_thr_1, noise=None, random_state=None):
+        """
+        See ensemble.SubGANEnsemble.train_step. Every shard gets the noise of its clusters and a seed of its Nash
+        evaluation, drawn from random_state or else from numpy's global generator of the main process, so that the
+        random state of a run, and of a resumed run, lives in the main process only.
+        """
+
+        active = np.asarray(active, dtype=bool)
+        evaluate = np.asarray(evaluate, dtype=bool)
+        rng = np.random if random_state is None else np.random.RandomState(random_state)
+        seeds = dict((tuple(group), int(seed)) for group, seed in zip(self.groups, rng.randint(2 ** 31 - 1, size=len(self.groups))))
+        results = self._call('train_step', lambda group: ([np.ascontiguousarray(real_batches[c]) for c in group],
+                                                           active[group], evaluate[group], nash_thr_1,
+                                                           _group_noise(noise, group, max(real_batches[c].shape[0] for c in group)),
+                                                           seeds[tuple(group)]))
+
+        ratios = np.full((self.n_clusters,), np.nan)
+        for group, (group_ratios, _) in zip(self.groups, results):
+            ratios[group] = group_ratios
+
+        # the losses are sums over the clusters, nan only if nan on every shard
+        shard_losses = np.array([group_losses for _, group_losses in results])
+        losses = np.where(np.all(np.isnan(shard_losses), axis=0), np.nan, np.nansum(shard_losses, axis=0))
+
+        return ratios, losses
+
+    def get_state(self):
+        """
+        See ensemble.SubGANEnsemble.get_state, the states of the groups are listed in order.
+        """
+
+        return self._call('get_state', lambda group: ())
+
+    def set_state(self, state):
+        """
+        See ensemble.SubGANEnsemble.set_state, state is returned by get_state with the same groups.
+        """
+
+        states = dict(zip(map(tuple, self.groups), state))
+        self._call('set_state', lambda group: (states[tuple(group)],))
+
+    def generate(self, counts, noise=None):
+        """
+        See ensemble.SubGANEnsemble.generate, every shard gets the noise of its clusters.
+        """
+
+        results = self._call('generate', lambda group: ([counts[c] for c in group],
+                                                        _group_noise(noise, group, max(counts[c] for c in group))))
+
+        generated = [None] * self.n_clusters
+        for group, result in zip(self.groups, results):
+            for c, points in zip(group, result):
+                generated[c] = points
+
+        return generated
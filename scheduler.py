@@ -0,0 +1,157 @@
+import numpy as np
+
+import ensemble
+
+
+def _relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+class SheddingSubGANs:
+    """
+    The sub-GANs of one side with the interface of ensemble.SubGANEnsemble, shedding the work of the converged ones.
+    A sub-generator that is stopped never trains again and its sub-discriminator is only used to train it, so once
+    stopped, a sub-GAN is frozen: its generator is kept as NumPy weights and a pool of its generated points stands in
+    for generate, refreshed every refresh_every epochs. The frozen sub-GANs stay in the Keras ensemble, masked, until
+    they make up compact_ratio of it; the ensemble is then rebuilt with the active sub-GANs only, so the cost of an
+    epoch drops with the number of converged clusters and the padded mini-batch of every bucket shrinks to its largest
+    active one. The active sub-GANs are ensemble.BucketedSubGANs.
+
+    Parameters
+    ----------
+    n_clusters (int) number of sub-GANs
+    latent_size (int) dimension of the data
+    dis_size (int) width of the first layer of the sub-discriminators
+    lr_d (float) learning rate of the sub-discriminators
+    lr_g (float) learning rate of the sub-generators
+    decay (float) learning rate decay
+    momentum (float) momentum of SGD
+    shared_trunk (bool) whether the sub-discriminators share their first layer
+    batch_sizes (list) expected mini-batch size of each cluster, see ensemble.BucketedSubGANs
+    pool_size (int) number of points in the pool of every frozen sub-generator
+    refresh_every (int) number of epochs between two refreshes of the pools, never refreshed if 0
+    compact_ratio (float) fraction of frozen sub-GANs in the ensemble triggering its rebuild
+    seed (int) seed of the noise of the pools
+    """
+
+    def __init__(self, n_clusters, latent_size, dis_size, lr_d, lr_g, decay, momentum, shared_trunk=False,
+                 batch_sizes=None, pool_size=1000, refresh_every=50, compact_ratio=0.5, seed=None):
+
+        self.n_clusters = n_clusters
+        self.latent_size = latent_size
+        self.pool_size = pool_size
+        self.refresh_every = refresh_every
+        self.compact_ratio = compact_ratio
+        self.rng = np.random.RandomState(seed)
+
+        self.gans = ensemble.BucketedSubGANs(n_clusters, latent_size, dis_size, lr_d, lr_g, decay, momentum,
+                                             shared_trunk=shared_trunk, batch_sizes=batch_sizes)
+        self.members = np.arange(n_clusters)
+        self.frozen = {}
+        self.pools = {}
+        self._steps = 0
+
+    def _forward(self, c, noise):
+        """
+        Runs the frozen sub-generator c on noise of shape (n_samples, latent_size).
+        """
+
+        kernel_1, bias_1, kernel_2, bias_2 = self.frozen[c]
+        return _relu(np.dot(_relu(np.dot(noise, kernel_1) + bias_1), kernel_2) + bias_2)
+
+    def _refresh(self, clusters):
+        for c in clusters:
+            self.pools[c] = self._forward(c, self.rng.uniform(0, 1, (self.pool_size, self.latent_size)))
+
+    def _freeze(self, stopped):
+        """
+        Keeps the generator weights of the newly stopped member clusters and fills their pools.
+        """
+
+        for m in stopped:
+            self.frozen[int(self.members[m])] = self.gans.generator_weights(int(m))
+        self._refresh([int(self.members[m]) for m in stopped])
+
+    def _compact(self, keep):
+        """
+        Rebuilds the ensemble with the member clusters keep, None once no member is left.
+        """
+
+        self.gans = self.gans.subset(keep) if keep.shape[0] > 0 else None
+        self.members = self.members[keep]
+
+    def train_step(self, real_batches, active, evaluate, nash_thr_1, noise=None, random_state=None):
+        """
+        See ensemble.SubGANEnsemble.train_step, only the sub-GANs not frozen are trained and evaluated.
+        """
+
+        active = np.asarray(active, dtype=bool)
+        evaluate = np.asarray(evaluate, dtype=bool)
+        ratios = np.full((self.n_clusters,), np.nan)
+        losses = np.full((2,), np.nan)
+
+        if self.gans is not None:
+            member_active = active[self.members]
+            newly_stopped = np.flatnonzero(~member_active & np.array([int(c) not in self.frozen for c in self.members]))
+            if newly_stopped.shape[0] > 0:
+                self._freeze(newly_stopped)
+            if np.sum(~member_active) >= self.compact_ratio * self.members.shape[0]:
+                self._compact(np.flatnonzero(member_active))
+
+        if self.gans is not None:
+            batches = [real_batches[c] for c in self.members]
+            if noise is not None:
+                noise = noise[:max(batch.shape[0] for batch in batches), self.members]
+            member_ratios, losses = self.gans.train_step(batches, active[self.members], evaluate[self.members],
+                                                         nash_thr_1, noise=noise, random_state=random_state)
+            ratios[self.members] = member_ratios
+
+        self._steps += 1
+        if self.refresh_every and self._steps % self.refresh_every == 0:
+            self._refresh(list(self.pools))
+
+        return ratios, losses
+
+    def generate(self, counts, noise=None):
+        """
+        See ensemble.SubGANEnsemble.generate, the frozen sub-generators draw their points from their pools.
+        """
+
+        generated = [None] * self.n_clusters
+        for c in self.pools:
+            if c not in self.members:
+                generated[c] = self.pools[c][self.rng.randint(self.pool_size, size=counts[c])]
+
+        if self.gans is not None:
+            member_counts = [counts[c] for c in self.members]
+            if noise is not None:
+                noise = noise[:max(member_counts), self.members]
+            for c, points in zip(self.members, self.gans.generate(member_counts, noise=noise)):
+                generated[c] = points
+
+        return generated
+
+    def get_state(self):
+        """
+        See ensemble.SubGANEnsemble.get_state, with the members, the frozen sub-generators and their pools.
+        """
+
+        return {'gans': self.gans.get_state() if self.gans is not None else None, 'members': self.members.copy(),
+                'frozen': dict((c, [w.copy() for w in weights]) for c, weights in self.frozen.items()),
+                'pools': dict((c, pool.copy()) for c, pool in self.pools.items()), 'steps': self._steps,
+                'rng': self.rng.get_state()}
+
+    def set_state(self, state):
+        """
+        See ensemble.SubGANEnsemble.set_state, state is returned by get_state.
+        """
+
+        if state['members'].shape[0] < self.members.shape[0]:
+            self.gans = self.gans.subset(state['members']) if state['members'].shape[0] > 0 else None
+        self.members = state['members'].copy()
+        if self.gans is not None:
+            self.gans.set_state(state['gans'])
+        self.frozen = dict((c, [w.copy() for w in weights]) for c, weights in state['frozen'].items())
+        self.pools = dict((c, pool.copy()) for c, pool in state['pools'].items())
+        self._steps = state['steps']
+        self.rng.set_state(state['rng'])
@@ -0,0 +1,99 @@
+import argparse
+import collections
+import multiprocessing
+
+import pandas as pd
+
+import inference
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Score data with a trained RCC-Dual-GAN discriminator.")
+    parser.add_argument('--model', nargs='?', default='discriminator.h5',
+                        help='Input the path of the trained discriminator, a .npz export is scored with NumPy only.')
+    parser.add_argument('--path', nargs='?', default='Data/Stamps/test.csv',
+                        help='Input the path of the data to score.')
+    parser.add_argument('--output', nargs='?', default='scores.csv',
+                        help='Output the path of the id/score rows.')
+    parser.add_argument('--labeled', type=int, default=1,
+                        help='1 if the second column holds a label, which is skipped, 0 otherwise.')
+    parser.add_argument('--chunk_size', type=int, default=100000,
+                        help='Number of rows read and scored at once.')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of scoring processes, 0 to score in the main process.')
+    return parser.parse_args()
+
+
+# Read the data in chunks of rows: id, optional label, features
+def read_chunks(path, chunk_size, labeled=1):
+    for chunk in pd.read_csv(path, sep=' ', header=None, chunksize=chunk_size):
+        ids = chunk.pop(0).values
+        if labeled:
+            chunk.pop(1)
+        yield ids, chunk.values
+
+
+# The model is loaded once per worker
+_model = None
+
+
+def _init_worker(model_path):
+    global _model
+    if model_path.endswith('.npz'):
+        _model = inference.NumpyDiscriminator.load(model_path)
+    else:
+        from keras.models import load_model
+        _model = load_model(model_path)
+
+
+def _score(chunk):
+    ids, x = chunk
+    return ids, _model.predict(x, batch_size=min(x.shape[0], 10000), verbose=0).ravel()
+
+
+def _write(output, result):
+    ids, scores = result
+    pd.DataFrame({'id': ids, 'score': scores}).to_csv(output, sep=' ', header=False, index=False,
+                                                      float_format='%.8f', columns=['id', 'score'])
+
+
+def score_file(model_path, path, output_path, chunk_size=100000, workers=1, labeled=1):
+    """
+    Scores a space separated file chunk by chunk and writes one "id score" row per input row, in the input order. At
+    most two chunks per worker are in flight, so the memory used does not depend on the size of the file.
+
+    Parameters
+    ----------
+    model_path (string) path of the trained discriminator
+    path (string) path of the data to score
+    output_path (string) path of the scores
+    chunk_size (int) number of rows read and scored at once
+    workers (int) number of scoring processes, 0 to score in the main process
+    labeled (int) 1 if the second column holds a label
+    """
+
+    with open(output_path, 'w') as output:
+        if workers == 0:
+            _init_worker(model_path)
+            for chunk in read_chunks(path, chunk_size, labeled):
+                _write(output, _score(chunk))
+            return
+
+        # spawn fresh workers, forking a process that already holds a deep learning backend is unsafe
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(workers, initializer=_init_worker, initargs=(model_path,))
+        try:
+            pending = collections.deque()
+            for chunk in read_chunks(path, chunk_size, labeled):
+                pending.append(pool.apply_async(_score, (chunk,)))
+                if len(pending) >= 2 * workers:
+                    _write(output, pending.popleft().get())
+            while pending:
+                _write(output, pending.popleft().get())
+        finally:
+            pool.terminate()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    score_file(args.model, args.path, args.output, args.chunk_size, args.workers, args.labeled)
@@ -0,0 +1,148 @@
+import numpy as np
+
+import metrics
+
+
+def stratified_subsample(labels, size, random_state=None):
+    """
+    Draws row indices keeping the proportion of every label, with at least one row per label.
+
+    Parameters
+    ----------
+    labels (array) label of each row
+    size (int) number of rows to draw
+    random_state (RandomState) random generator, numpy's global one if None
+    """
+
+    rng = np.random if random_state is None else random_state
+
+    labels = np.ravel(labels)
+    rows = []
+    for label in np.unique(labels):
+        candidates = np.flatnonzero(labels == label)
+        n = min(candidates.shape[0], max(1, int(round(size * candidates.shape[0] / float(labels.shape[0])))))
+        rows.append(rng.choice(candidates, n, replace=False))
+
+    return np.sort(np.concatenate(rows))
+
+
+class ModelSelector:
+    """
+    Selection of the optimal final discriminator by its eva score. The score is computed every eval_every epochs,
+    optionally on a fixed stratified subsample of the training data, and the best weights are kept as an in-memory
+    snapshot. They are written to disk by checkpoint() every checkpoint_every epochs if they improved, and by save() at
+    the end.
+
+    Parameters
+    ----------
+    model (Model) the final discriminator
+    x (array) training data
+    y (array) 1 for the identified anomalies, 0 for the unlabeled data
+    eval_every (int) number of epochs between two evaluations
+    eval_size (int) number of rows of the stratified subsample, all the rows if None or 0
+    checkpoint_every (int) number of epochs between two writes of the best weights, only at the end if 0
+    path (string) file the best model is written to
+    seed (int) seed of the subsample
+    """
+
+    def __init__(self, model, x, y, eval_every=1, eval_size=None, checkpoint_every=0, path='discriminator.h5',
+                 seed=None):
+
+        self.model = model
+        self.eval_every = max(1, eval_every)
+        self.checkpoint_every = checkpoint_every
+        self.path = path
+
+        if eval_size and eval_size < x.shape[0]:
+            rows = stratified_subsample(y, eval_size, np.random.RandomState(seed))
+            x, y = x[rows], y[rows]
+        self.x = x
+        self.y = y
+
+        self.best_score = 1
+        self.best_weights = None
+        self._saved = True
+
+    def update(self, epoch):
+        """
+        Evaluates the model if the epoch is on the schedule and keeps its weights if they are the best so far.
+
+        Parameters
+        ----------
+        epoch (int) current epoch, starting from 0
+
+        Returns
+        -------
+        score (float) eva score of the model, None if it was not evaluated
+        """
+
+        score = None
+        if epoch % self.eval_every == 0:
+            score = metrics.eva_score(self.model.predict(self.x), self.y)
+            if self.best_score >= score:
+                self.best_score = score
+                self.best_weights = self.model.get_weights()
+                self._saved = False
+
+        return score
+
+    def checkpoint(self, epoch):
+        """
+        Writes the best weights if the epoch is on the checkpoint schedule and they changed since the last write.
+
+        Parameters
+        ----------
+        epoch (int) current epoch, starting from 0
+
+        Returns
+        -------
+        written (bool) whether the model was written
+        """
+
+        if self.checkpoint_every and (epoch + 1) % self.checkpoint_every == 0 and not self._saved:
+            self.save()
+            return True
+
+        return False
+
+    def get_state(self):
+        """
+        Returns the best score and weights so far and whether they are written.
+        """
+
+        return {'best_score': self.best_score, 'best_weights': self.best_weights, 'saved': self._saved}
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state.
+
+        Parameters
+        ----------
+        state (dict) state of a selector of the same model
+        """
+
+        self.best_score = state['best_score']
+        self.best_weights = state['best_weights']
+        self._saved = state['saved']
+
+    def restore(self):
+        """
+        Loads the best weights into the model.
+        """
+
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+
+    def save(self):
+        """
+        Writes the model with the best weights to path, the current weights of the model are kept.
+        """
+
+        if self.best_weights is None:
+            return
+
+        current = self.model.get_weights()
+        self.model.set_weights(self.best_weights)
+        self.model.save(self.path)
+        self.model.set_weights(current)
+        self._saved = True
@@ -0,0 +1,318 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import data
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'RCC-Dual-GAN.py')
+FILES = ('out10.csv', 'unl10.csv', 'test.csv')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a hyperparameter sweep of RCC-Dual-GAN on a pool of processes.")
+    parser.add_argument('--spec', nargs='?', default='sweep.json',
+                        help='Input the path of the JSON search spec with "datasets", "fixed" and "grid" or "random".')
+    parser.add_argument('--search', nargs='?', default='', choices=['', 'grid', 'random'],
+                        help='grid or random search, the one given by the spec if empty.')
+    parser.add_argument('--trials', type=int, default=10,
+                        help='Number of sampled settings of a random search, each run on every dataset.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random search.')
+    parser.add_argument('--data_dir', nargs='?', default='Data',
+                        help='Input the directory of the datasets, each one a directory with out10.csv, unl10.csv and test.csv.')
+    parser.add_argument('--datasets', nargs='?', default='',
+                        help='Comma separated datasets, those of the spec or else all the datasets of data_dir if empty.')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='Number of trials run at once.')
+    parser.add_argument('--output', nargs='?', default='sweep',
+                        help='Output the directory of the trials, of the shared caches and of results.csv.')
+    parser.add_argument('--stop_after', type=int, default=200,
+                        help='First epoch at which a losing trial can be stopped.')
+    parser.add_argument('--stop_margin', type=float, default=0.05,
+                        help='AUC below the median of the other trials on the dataset at which a trial is stopped.')
+    parser.add_argument('--stop_min_trials', type=int, default=3,
+                        help='Number of other trials on the dataset that must have reached the epoch to stop a trial.')
+    parser.add_argument('--poll_seconds', type=float, default=1,
+                        help='Number of seconds between two polls of the running trials.')
+    return parser.parse_args()
+
+
+def grid_settings(grid):
+    """
+    All the combinations of the values of a grid, the parameters in sorted order.
+
+    Parameters
+    ----------
+    grid (dict) list of values of every parameter
+    """
+
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def random_settings(space, n_settings, seed=0):
+    """
+    Settings drawn at random from a search space. Every parameter is given as {"uniform": [low, high]},
+    {"log_uniform": [low, high]}, {"int": [low, high]} (high included) or {"choice": [values]}.
+
+    Parameters
+    ----------
+    space (dict) distribution of every parameter
+    n_settings (int) number of settings
+    seed (int) seed of the random generator
+    """
+
+    rng = np.random.RandomState(seed)
+    settings = []
+    for _ in range(n_settings):
+        setting = {}
+        for name in sorted(space):
+            (kind, values), = space[name].items()
+            if kind == 'uniform':
+                setting[name] = float(rng.uniform(values[0], values[1]))
+            elif kind == 'log_uniform':
+                setting[name] = float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+            elif kind == 'int':
+                setting[name] = int(rng.randint(values[0], values[1] + 1))
+            elif kind == 'choice':
+                setting[name] = values[rng.randint(len(values))]
+            else:
+                raise ValueError('unknown distribution {} of {}'.format(kind, name))
+        settings.append(setting)
+    return settings
+
+
+class Trial:
+    """
+    One run of RCC-Dual-GAN.py in its own directory, so that its discriminator.h5, discriminator.npz, training state
+    and log do not collide with the other trials. Its progress is read from its telemetry file.
+
+    Parameters
+    ----------
+    index (int) number of the trial
+    dataset (string) name of the dataset
+    setting (dict) value of every command line argument of the script
+    directory (string) directory of the trial
+    """
+
+    def __init__(self, index, dataset, setting, directory):
+
+        self.index = index
+        self.dataset = dataset
+        self.setting = setting
+        self.directory = directory
+        self.process = None
+        self.status = 'pending'
+        self.start = None
+        self.seconds = None
+        self.aucs = {}
+        self.test = None
+        self.setup_done = False
+        self._offset = 0
+
+    def launch(self, arguments):
+        """
+        Starts the script with the setting of the trial followed by arguments, its output going to log.txt.
+
+        Parameters
+        ----------
+        arguments (list) arguments shared by all the trials
+        """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        command = [sys.executable, SCRIPT] + arguments + ['--telemetry', 'telemetry.jsonl']
+        for name in sorted(self.setting):
+            command += ['--' + name, str(self.setting[name])]
+        with open(os.path.join(self.directory, 'log.txt'), 'w') as log:
+            self.process = subprocess.Popen(command, cwd=self.directory, stdout=log, stderr=subprocess.STDOUT)
+        self.status = 'running'
+        self.start = time.time()
+
+    def poll(self):
+        """
+        Reads the telemetry records written since the last poll and returns whether the process has exited.
+        """
+
+        returncode = self.process.poll()
+        path = os.path.join(self.directory, 'telemetry.jsonl')
+        if os.path.exists(path):
+            with open(path) as f:
+                f.seek(self._offset)
+                chunk = f.read()
+            # a record is only read once its line is complete
+            chunk = chunk[:chunk.rfind('\n') + 1]
+            self._offset += len(chunk)
+            for line in chunk.splitlines():
+                record = json.loads(line)
+                if record['record'] == 'setup':
+                    self.setup_done = True
+                elif record['record'] == 'epoch' and record.get('auc') is not None:
+                    self.aucs[record['epoch']] = record['auc']
+                elif record['record'] == 'test':
+                    self.test = record
+
+        if returncode is not None:
+            self.seconds = time.time() - self.start
+            self.status = 'done' if returncode == 0 and self.test is not None else 'failed'
+            return True
+        return False
+
+    def best_auc(self, epoch):
+        """
+        Best training AUC up to epoch, None if none was reported.
+        """
+
+        aucs = [auc for e, auc in self.aucs.items() if e <= epoch]
+        return max(aucs) if aucs else None
+
+    def stop(self):
+        """
+        Terminates the process of a losing trial.
+        """
+
+        self.process.terminate()
+        self.process.wait()
+        self.seconds = time.time() - self.start
+        self.status = 'stopped'
+
+    def row(self, names):
+        """
+        Row of the trial in the results table, with the parameters in names.
+        """
+
+        last = max(self.aucs) if self.aucs else None
+        return ([self.index, self.dataset] + [self.setting.get(name, '') for name in names] +
+                [self.status, self.test['auc'] if self.test else '', self.test['precision'] if self.test else '',
+                 self.best_auc(last) if last is not None else '', last if last is not None else '',
+                 '{:.1f}'.format(self.seconds) if self.seconds is not None else ''])
+
+
+def losing(trial, trials, stop_after, margin, min_trials):
+    """
+    Median stopping rule: a trial is losing once its best training AUC at its last reported epoch is below by margin
+    the median of the best AUCs at that epoch of the other trials on the same dataset that reached it.
+
+    Parameters
+    ----------
+    trial (Trial) running trial
+    trials (list) all the trials
+    stop_after (int) first epoch at which a trial can be stopped
+    margin (float) AUC below the median
+    min_trials (int) number of other trials that must have reached the epoch
+    """
+
+    if not trial.aucs:
+        return False
+    epoch = max(trial.aucs)
+    if epoch < stop_after:
+        return False
+
+    others = [other.best_auc(epoch) for other in trials
+              if other is not trial and other.dataset == trial.dataset and other.aucs and max(other.aucs) >= epoch]
+    others = [auc for auc in others if auc is not None]
+    if len(others) < min_trials:
+        return False
+    return trial.best_auc(epoch) < np.median(others) - margin
+
+
+def write_results(path, trials, names):
+    """
+    Writes the results table, one row per trial.
+    """
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial', 'dataset'] + names + ['status', 'test_auc', 'precision', 'train_auc', 'epoch', 'seconds'])
+        writer.writerows(trial.row(names) for trial in trials)
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    search = args.search or ('grid' if 'grid' in spec else 'random')
+    if search == 'grid':
+        settings = grid_settings(spec.get('grid', {}))
+    else:
+        settings = random_settings(spec.get('random', {}), args.trials, args.seed)
+    fixed = spec.get('fixed', {})
+    settings = [dict(fixed, **setting) for setting in settings]
+    names = sorted(set(name for setting in settings for name in setting))
+
+    if args.datasets:
+        datasets = args.datasets.split(',')
+    elif 'datasets' in spec:
+        datasets = spec['datasets']
+    else:
+        datasets = sorted(name for name in os.listdir(args.data_dir)
+                          if all(os.path.exists(os.path.join(args.data_dir, name, f)) for f in FILES))
+
+    output = os.path.abspath(args.output)
+    data_cache = os.path.join(output, 'data_cache')
+    rcc_cache = os.path.join(output, 'rcc_cache')
+
+    # The binary caches of the data files are built once here, the trials only map them
+    arguments = {}
+    for dataset in datasets:
+        paths = [os.path.abspath(os.path.join(args.data_dir, dataset, f)) for f in FILES]
+        for path in paths:
+            data.load_table(path, cache_dir=data_cache)
+        arguments[dataset] = ['--path_out', paths[0], '--path_unl', paths[1], '--path_test', paths[2],
+                              '--data_cache', data_cache, '--rcc_cache', rcc_cache]
+
+    trials = [Trial(index, dataset, setting, os.path.join(output, 'trial_{:04d}'.format(index)))
+              for index, (dataset, setting) in enumerate(itertools.product(datasets, settings))]
+    print('{} trials: {} settings on {} datasets, {} at once'.format(len(trials), len(settings), len(datasets), args.jobs))
+
+    # Until a trial on a dataset has clustered it, i.e. written its setup record, it is the only one running on the
+    # dataset, so that RCC runs once per dataset and the other trials read the partition from the shared cache
+    results = os.path.join(output, 'results.csv')
+    running = []
+    try:
+        while True:
+            for trial in list(running):
+                if trial.poll():
+                    running.remove(trial)
+                    print('trial {} {}: {}'.format(trial.index, trial.status,
+                                                   trial.test['auc'] if trial.test else 'see {}'.format(trial.directory)))
+                elif losing(trial, trials, args.stop_after, args.stop_margin, args.stop_min_trials):
+                    trial.stop()
+                    running.remove(trial)
+                    print('trial {} stopped at epoch {}'.format(trial.index, max(trial.aucs)))
+
+            clustered = set(trial.dataset for trial in trials if trial.setup_done or trial.status in ('done', 'failed'))
+            clustering = set(trial.dataset for trial in running if not trial.setup_done)
+            for trial in trials:
+                if len(running) >= args.jobs:
+                    break
+                if trial.status == 'pending' and (trial.dataset in clustered or trial.dataset not in clustering):
+                    trial.launch(arguments[trial.dataset])
+                    running.append(trial)
+                    clustering.add(trial.dataset)
+                    print('trial {} started on {}: {}'.format(trial.index, trial.dataset, trial.setting))
+
+            write_results(results, trials, names)
+            if not running and all(trial.status != 'pending' for trial in trials):
+                break
+            time.sleep(args.poll_seconds)
+    finally:
+        for trial in running:
+            trial.stop()
+        write_results(results, trials, names)
+
+    for dataset in datasets:
+        done = sorted((trial for trial in trials if trial.dataset == dataset and trial.test),
+                      key=lambda trial: -trial.test['auc'])
+        if done:
+            print('{}: best test AUC {} with {}'.format(dataset, done[0].test['auc'], done[0].setting))
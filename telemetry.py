@@ -0,0 +1,204 @@
+import collections
+import contextlib
+import csv
+import json
+import math
+import time
+
+
+def cprofile_hook(path):
+    """
+    Profiler factory writing one cProfile dump per profiled epoch, to {path}.epoch{epoch}.prof.
+
+    Parameters
+    ----------
+    path (string) prefix of the dumps
+    """
+
+    import cProfile
+
+    def start(epoch):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def stop():
+            profiler.disable()
+            profiler.dump_stats('{}.epoch{}.prof'.format(path, epoch))
+
+        return stop
+
+    return start
+
+
+class Telemetry:
+    """
+    Per-phase timers and per-epoch records of a training run. The time spent in every phase is accumulated with
+    time.perf_counter and written with the values of each epoch as JSON lines or CSV rows, so a regression can be
+    traced to its phase. A summary record with the total time of every phase is written by close(). With no path,
+    the timers still run and nothing is written.
+
+    Parameters
+    ----------
+    path (string) output file, nothing is written if None
+    fmt (string) 'jsonl' or 'csv'
+    profile_epochs (list) epochs run under the profiler
+    profiler (function) profiler(epoch) starts profiling and returns the function stopping it, cProfile dumps next to
+    path if None
+    append (bool) whether the records are appended to an existing file, e.g. when a run is resumed
+    """
+
+    def __init__(self, path=None, fmt='jsonl', profile_epochs=(), profiler=None, append=False):
+
+        if fmt not in ('jsonl', 'csv'):
+            raise ValueError("fmt must be 'jsonl' or 'csv', got {}".format(fmt))
+
+        self.path = path
+        self.fmt = fmt
+        self.profile_epochs = set(profile_epochs)
+        self.profiler = profiler
+        if self.profiler is None and self.profile_epochs:
+            self.profiler = cprofile_hook(path or 'telemetry')
+
+        self.totals = collections.OrderedDict()
+        self._epoch = collections.OrderedDict()
+        self._epoch_start = None
+        self._stop_profiler = None
+
+        self._file = open(path, 'a' if append else 'w') if path else None
+        self._writer = None
+        if append and fmt == 'csv' and path and self._file.tell() > 0:
+            self._writer = csv.writer(self._file)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager timing one phase, the time is added to the current epoch and to the totals.
+
+        Parameters
+        ----------
+        name (string) phase name
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        """
+        Adds time measured elsewhere to a phase.
+
+        Parameters
+        ----------
+        name (string) phase name
+        seconds (float) time spent in the phase
+        """
+
+        self._epoch[name] = self._epoch.get(name, 0.0) + seconds
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def start_epoch(self, epoch):
+        """
+        Resets the timers of the epoch and starts the profiler if the epoch is selected.
+
+        Parameters
+        ----------
+        epoch (int) current epoch, starting from 0
+        """
+
+        self._epoch = collections.OrderedDict()
+        self._epoch_start = time.perf_counter()
+        if epoch in self.profile_epochs:
+            self._stop_profiler = self.profiler(epoch)
+
+    def end_epoch(self, epoch, **values):
+        """
+        Stops the profiler and writes the record of the epoch: its phase timers, its total time and values.
+
+        Parameters
+        ----------
+        epoch (int) current epoch, starting from 0
+        values (dict) losses, counts and scores of the epoch
+        """
+
+        if self._stop_profiler is not None:
+            self._stop_profiler()
+            self._stop_profiler = None
+
+        record = collections.OrderedDict([('record', 'epoch'), ('epoch', epoch)])
+        record['seconds'] = time.perf_counter() - self._epoch_start if self._epoch_start is not None else None
+        for name, seconds in self._epoch.items():
+            record[name + '_seconds'] = seconds
+        record.update(values)
+        self.write(record)
+        self._epoch = collections.OrderedDict()
+        self._epoch_start = None
+
+    def write(self, record):
+        """
+        Writes one record, as one JSON line or, in CSV, as one "record,epoch,key,value" row per value so that records
+        with different keys share the columns.
+
+        Parameters
+        ----------
+        record (dict) values of the record, numbers, strings or None
+        """
+
+        if self._file is None:
+            return
+
+        record = collections.OrderedDict((key, _plain(value)) for key, value in record.items())
+        if self.fmt == 'jsonl':
+            self._file.write(json.dumps(record) + '\n')
+        else:
+            if self._writer is None:
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(['record', 'epoch', 'key', 'value'])
+            name, epoch = record.pop('record', None), record.pop('epoch', None)
+            self._writer.writerows([name, epoch, key, value] for key, value in record.items())
+        self._file.flush()
+
+    def write_phases(self, record, **values):
+        """
+        Writes a record of the phases timed outside of the epochs, e.g. the data load and RCC, and resets them.
+
+        Parameters
+        ----------
+        record (string) name of the record
+        values (dict) other values of the record
+        """
+
+        fields = collections.OrderedDict([('record', record)])
+        for name, seconds in self._epoch.items():
+            fields[name + '_seconds'] = seconds
+        fields.update(values)
+        self.write(fields)
+        self._epoch = collections.OrderedDict()
+
+    def close(self):
+        """
+        Writes the summary record with the total time of every phase and closes the file.
+        """
+
+        if self._file is None:
+            return
+
+        summary = collections.OrderedDict([('record', 'summary')])
+        for name, seconds in self.totals.items():
+            summary[name + '_seconds'] = seconds
+        self.write(summary)
+        self._file.close()
+        self._file = None
+
+
+def _plain(value):
+    """
+    Converts numpy scalars to Python numbers and nan to None, so that the records are valid JSON.
+    """
+
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value